@@ -0,0 +1,164 @@
+import pandas as pd
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+# composition .txt exports: a header of header_lines lines, then compound name and concentration (g/L) on alternating
+# lines. Blank lines and page breaks ("\x0c") in between are skipped
+header_lines = 4
+
+# a name line that also holds its concentration: "DEXTRAN SULFATE 0.05"
+name_value_pattern = re.compile(r"^(?P<name>.*\S)\s+(?P<value>[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?)$")
+
+
+def _parse_value(text):
+    """
+    Concentration line as float, None when the line is not a number
+    """
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def compound_key(name):
+    """
+    Compound name used to look compounds up across media: upper case, single spaces
+    """
+    return " ".join(str(name).split()).upper()
+
+def read_composition(path, header=header_lines):
+    """
+    Reads one media composition .txt file, line by line. Entries that don't follow the name / value layout are not
+    patched silently, every one is listed in the returned problems:
+        "name and value on one line" - the value is split off the name and kept
+        "compound without value"     - name line followed by another name, left out
+        "value without compound"     - number where a compound name was expected, left out
+        "duplicate compound"         - compound listed twice in the file, the first entry is kept
+
+    Input: path - composition .txt file, header - int, number of header lines skipped
+    Return: tuple (dataframe with columns "Compound Name", "Compound", "Concentration g/L", "Medium",
+                   list of problems as tuples (medium, line number, line, problem))
+    """
+    medium = os.path.splitext(os.path.basename(str(path)))[0]
+    L_rows, L_problems = [], []
+    pending = None  # (line number, name) waiting for its value
+
+    def no_value(number, name):
+        match = name_value_pattern.match(name)
+        if match is not None:
+            L_rows.append((match.group("name"), float(match.group("value")), number))
+            L_problems.append((medium, number, name, "name and value on one line"))
+        else:
+            L_problems.append((medium, number, name, "compound without value"))
+
+    with open(path, "r") as f:
+        for number, line in enumerate(f, 1):
+            text = line.replace("\x0c", "").strip()
+            if not text:
+                continue  # blank lines and page breaks
+            if header > 0:
+                header -= 1
+                continue
+
+            value = _parse_value(text)
+            if pending is None:
+                if value is None:
+                    pending = (number, text)
+                else:
+                    L_problems.append((medium, number, text, "value without compound"))
+            elif value is None:
+                no_value(*pending)
+                pending = (number, text)
+            else:
+                L_rows.append((pending[1], value, pending[0]))
+                pending = None
+
+    if pending is not None:
+        no_value(*pending)
+
+    df = pd.DataFrame(L_rows, columns=["Compound Name", "Concentration g/L", "line"])
+    df.insert(1, "Compound", [compound_key(i) for i in df["Compound Name"]])
+    df["Medium"] = medium
+
+    duplicated = df["Compound"].duplicated()
+    for name, number in zip(df.loc[duplicated, "Compound Name"], df.loc[duplicated, "line"]):
+        L_problems.append((medium, number, name, "duplicate compound"))
+    L_problems.sort(key=lambda i: -1 if i[1] is None else i[1])
+
+    return df[~duplicated].drop(columns="line").reset_index(drop=True), L_problems
+
+def _read_composition(path, header):
+    """
+    read_composition inside the worker pool: a file that can't be read is returned as a problem
+    """
+    try:
+        return read_composition(path, header)
+    except Exception as e:
+        medium = os.path.splitext(os.path.basename(str(path)))[0]
+        return None, [(medium, None, str(path), "FAILED to read: " + str(e))]
+
+def load_compositions(paths, workers=None, header=header_lines):
+    """
+    Parses media composition files into one component table, indexed by (Compound, Medium), in place of parsing
+    each .txt file by hand.
+
+    Input: paths - directory of composition .txt files, or list of file paths
+           workers (optional) - int, number of processes used to parse files in parallel. Default parses serially.
+           header - int, number of header lines of every file
+    Return: dataframe with a sorted (Compound, Medium) index and columns "Compound Name", "Concentration g/L".
+            See lookup_compound and media_table.
+    """
+    if isinstance(paths, str):
+        paths = sorted(os.path.join(paths, i) for i in os.listdir(paths) if i.lower().endswith(".txt"))
+
+    if workers is not None and workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_read_composition, paths, [header] * len(paths)))
+    else:
+        results = [_read_composition(i, header) for i in paths]
+
+    L_df = [df for df, problems in results if df is not None]
+    L_problems = [i for df, problems in results for i in problems]
+
+    columns = ["Compound", "Medium", "Compound Name", "Concentration g/L"]
+    df = pd.concat(L_df, ignore_index=True)[columns] if L_df else pd.DataFrame(columns=columns)
+    df = df.set_index(["Compound", "Medium"]).sort_index()
+
+    print("#### Media Composition Report ####")
+    print("\n")
+    print("Files parsed: " + str(len(L_df)) + " of " + str(len(paths)))
+    print("Media: " + str(df.index.get_level_values("Medium").nunique()))
+    print("Compounds: " + str(df.index.get_level_values("Compound").nunique()))
+    print("Entries: " + str(df.shape[0]))
+    if L_problems:
+        print("\n")
+        print("Malformed entries: " + str(len(L_problems)))
+        problems = pd.DataFrame(L_problems, columns=["medium", "line", "entry", "problem"])
+        problems["line"] = problems["line"].astype("Int64")
+        print(problems.to_string(index=False))
+
+    return df
+
+def lookup_compound(df, compound):
+    """
+    Concentration of one compound in every medium that contains it (binary search on the sorted index)
+
+    Input: df - load_compositions output, compound - compound name, any case/spacing
+    Return: series, index = medium, values = concentration g/L. Empty if no medium contains the compound
+    """
+    try:
+        return df.loc[compound_key(compound), "Concentration g/L"]
+    except KeyError:
+        return pd.Series([], index=pd.Index([], name="Medium"), name="Concentration g/L", dtype=float)
+
+def media_table(df, media=None):
+    """
+    Wide table of the component database: one row per compound, one column per medium, NaN where a medium doesn't
+    contain the compound
+
+    Input: df - load_compositions output, media (optional) - list of media, default every medium
+    """
+    table = df["Concentration g/L"].unstack("Medium")
+    if media is not None:
+        table = table.reindex(columns=media)
+    return table
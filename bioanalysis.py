@@ -4,49 +4,118 @@ import matplotlib.pyplot as plt
 import matplotlib as mpl
 
 
-def grouped_histograms(df_data, df_group):
+def group_bincount(values, codes, n_groups, bins):
     """
+    Histogram of every group of one column in a single pass: bin edges are shared by all groups (computed on all the
+    data, as np.histogram would), and each value is counted at (group code, bin) with one bincount.
+
     arguments:
-    df_data = dataframe containing columns of data to be plotted as a histogram.
-    df_group = dataframe containing a single column of categorical data.
-                must be same number of rows as df_data.
+    values = 1D numpy array of data, Nan values are skipped
+    codes = 1D numpy array of group codes (0 to n_groups - 1, -1 = no group), same length as values
+    n_groups = int, number of groups
+    bins = int, number of bins
 
-    return: no object returned, however hist.png is saved in local dir
+    return: tuple (bin_edges, counts). counts = int array of shape (n_groups, bins)
     """
+    finite = np.isfinite(values)
+    bin_edges = np.histogram_bin_edges(values[finite], bins=bins)
 
-    # forcing to use the following colors in this order for hist
-    colors_list = ["blue", "crimson", "green", "cyan", "violet", "orange", "lime", "gold"]
+    keep = finite & (codes >= 0)
+    v = values[keep]
 
-    groups = df_group["Cond"].unique()  # array of unique groups
-    n = 0  # counting subplots
+    # bin of every value, right edge of the last bin included (same bins as np.histogram)
+    idx = np.searchsorted(bin_edges, v, side="right") - 1
+    idx[v == bin_edges[-1]] = bins - 1
 
-    # logic for # of subplot rows for (# rows) x 4 subplot grid
-    if len(df_data.columns) % 4 > 0:
-        plt_rows = (int(len(df_data.columns)) + 1)
-    else:
-        plt_rows = int(len(df_data.columns) / 4)
+    counts = np.bincount(codes[keep] * bins + idx, minlength=n_groups * bins).reshape(n_groups, bins)
+    return bin_edges, counts
 
-    fig = plt.figure(figsize=(30, 20))
+def histogram_counts(df_data, df_group):
+    """
+    Counts for grouped histograms of every column of df_data, one pass over each column for all groups.
+    (# of bins) = square root of number of data points, i.e., column length
 
-    # for every column, create a subplot.
+    arguments:
+    df_data = dataframe containing columns of data
+    df_group = dataframe containing a single column of categorical data, same number of rows as df_data
+
+    return: dictionary
+        "groups": list of groups, in order of first appearance
+        "columns": dictionary, key = column name, value = tuple (bin_edges, counts), counts has one row per group
+    """
+    codes, groups = pd.factorize(df_group.iloc[:, 0])  # group code of every row, -1 where no group
+    bins = max(int((df_data.shape[0]) ** (1 / 2)), 1)
+
+    columns = {}
     for i in df_data.columns:
+        values = df_data[i].to_numpy(dtype=float)
+        if not np.isfinite(values).any():
+            continue  # no data to bin
+        columns[i] = group_bincount(values, codes, len(groups), bins)
+
+    return {"groups": list(groups), "columns": columns}
+
+def draw_histograms(counts, file="hist.png"):
+    """
+    Draws precomputed grouped histograms (histogram_counts) on a (# rows) x 4 subplot grid, one subplot per column
+    and one set of bars per group.
+
+    return: no object returned, however the figure is saved to file (default hist.png in local dir)
+    """
 
-        bin_count = int(
-            (len(df[i])) ** (1 / 2))  # (# of bins) = sqaure root of number of data points, i.e., column length
-        bin_edges = np.histogram(df_data[i].dropna(), bins=bin_count)[
-            1]  # getting bin edges for all the data (all groups)
+    # forcing to use the following colors in this order for hist, matplotlib default colors after these
+    colors_list = ["blue", "crimson", "green", "cyan", "violet", "orange", "lime", "gold"]
+    groups = counts["groups"]
+    colors_list = colors_list + [None] * max(len(groups) - len(colors_list), 0)
+
+    # logic for # of subplot rows for (# rows) x 4 subplot grid
+    plt_rows = max(int(np.ceil(len(counts["columns"]) / 4)), 1)
 
+    fig = plt.figure(figsize=(30, max(20, 5 * plt_rows)))
+
+    # for every column, create a subplot.
+    n = 0  # counting subplots
+    for i, (bin_edges, col_counts) in counts["columns"].items():
         n += 1
         ax = fig.add_subplot(plt_rows, 4, n)
         ax.set_title(i, fontsize=20, fontweight="bold")
         ax.tick_params(axis='both', which='major', labelsize=16)
 
-        # for every group, draw a hist
-        for p, color in zip(groups, colors_list):
-            # index by group,
-            ax.hist(df_data[df_group.iloc[:, 0] == p][i].dropna(), bins=bin_edges, alpha=0.7, label=p, color=color)
-        plt.legend(fontsize=16)
+        # for every group, draw the precomputed bars (one weighted point per bin)
+        for p, color, bar_heights in zip(groups, colors_list, col_counts):
+            ax.hist(bin_edges[:-1], bins=bin_edges, weights=bar_heights, alpha=0.7, label=p, color=color)
+        ax.legend(fontsize=16)
 
-    plt.tight_layout
-    plt.savefig("hist.png", bbox_inches="tight", dpi=200)
+    fig.tight_layout()
+    fig.savefig(file, bbox_inches="tight", dpi=200)
     return
+
+
+def grouped_histograms(df_data, df_group, columns=None):
+    """
+    arguments:
+    df_data = dataframe containing columns of data to be plotted as a histogram.
+              or str, path of a bioreactor run store (bioreactor_results/BSRstore). Only the reactors in df_group
+              and the columns listed are read from it.
+    df_group = dataframe containing a single column of categorical data.
+                must be same number of rows as df_data.
+               or dict of {"Sample ID": "condition str"} when df_data is a run store.
+                example: {"R0009": "Fed-Batch", "R0010": "Fed-Batch", "R0011": "Perfusion"}
+    columns = list of columns to plot when df_data is a run store (e.g. ["VCD", "Gluc", "Lac"]), required with a store
+
+    return: counts (see histogram_counts), hist.png is saved in local dir
+    """
+
+    #### reading from the run store, only the grouped reactors ####
+    if isinstance(df_data, str):
+        from bioreactor_results.BSRstore import store_query
+
+        if not columns:
+            raise ValueError("columns must be listed when df_data is a run store, e.g. [\"VCD\", \"Gluc\", \"Lac\"]")
+        df = store_query(df_data, list(df_group), columns)
+        df_group = pd.DataFrame({"Cond": df["Sample ID"].map(df_group)})
+        df_data = df[columns]
+
+    counts = histogram_counts(df_data, df_group)
+    draw_histograms(counts)
+    return counts
@@ -0,0 +1,172 @@
+import pandas as pd
+import os
+import json
+import hashlib
+
+try:
+    import pyarrow  # parquet engine, optional. Falls back to pickle when not installed
+    _parquet = True
+except ImportError:
+    _parquet = False
+
+
+def _index_path(cache_dir):
+    return os.path.join(cache_dir, "index.json")
+
+def load_index(cache_dir):
+    """
+    Loads the cache index: dictionary. key = absolute file path, value = {"size", "mtime", "hash"}
+    """
+    try:
+        with open(_index_path(cache_dir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_index(cache_dir, index):
+    """
+    Writes the cache index back to cache_dir. Files on record that no longer exist (deleted or renamed exports) are
+    dropped from the index first
+    """
+    for path in [i for i in index if not os.path.exists(i)]:
+        del index[path]
+
+    tmp = _index_path(cache_dir) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp, _index_path(cache_dir))  # atomic, a crash never leaves half an index behind
+
+def content_hash(path, block_size=1 << 20):
+    """
+    Hashes the contents of a file in blocks, so large exports are never held in memory at once.
+
+    Return: str, hex digest
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def file_key(cache_dir, path, index=None):
+    """
+    Returns the content hash for a file. The hash is only recomputed when the size or mtime of the file differ
+    from what the index has on record, so unchanged files cost a single stat() call.
+
+    Input: cache_dir, path, index (optional, already loaded index dictionary - updated in place)
+    Return: str, content hash of the file
+    """
+    save = index is None
+    if index is None:
+        index = load_index(cache_dir)
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    record = index.get(path)
+
+    if record is not None and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime_ns:
+        return record["hash"]
+
+    index[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": content_hash(path)}
+    if save:
+        save_index(cache_dir, index)
+    return index[path]["hash"]
+
+def _entry_paths(cache_dir, key, stage):
+    base = os.path.join(cache_dir, key + "_" + stage)
+    return base + ".parquet", base + ".pkl"
+
+def cache_load(cache_dir, path, stage, index=None):
+    """
+    Loads the cached result of a parsing stage for a file.
+
+    Input: cache_dir, path of the instrument file, stage (str, e.g. "vicell_clean"), index (optional)
+    Return: dataframe, or None if the file has not been cached (or has changed since)
+    """
+    if not os.path.isdir(cache_dir):
+        return None
+
+    key = file_key(cache_dir, path, index)
+    for entry in _entry_paths(cache_dir, key, stage):
+        if os.path.exists(entry):
+            os.utime(entry)  # marking as recently used for eviction
+            if entry.endswith(".parquet"):
+                return pd.read_parquet(entry)
+            return pd.read_pickle(entry)
+    return None
+
+def cache_store(cache_dir, path, stage, df, index=None):
+    """
+    Stores the result of a parsing stage for a file. Parquet (columnar) is used when pyarrow is installed and
+    the dataframe can be written to it, otherwise the dataframe is pickled.
+
+    Input: cache_dir, path of the instrument file, stage (str), df (dataframe to store), index (optional)
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = file_key(cache_dir, path, index)
+    parquet, pickle = _entry_paths(cache_dir, key, stage)
+
+    if _parquet:
+        try:
+            df.to_parquet(parquet)
+            return
+        except Exception:
+            # mixed-type object columns (raw ViCell headers) or non-string column names can't go to parquet
+            if os.path.exists(parquet):
+                os.remove(parquet)
+    df.to_pickle(pickle)
+
+def cache_invalidate(cache_dir, path=None):
+    """
+    Removes cached results. Drops every stage cached for one file, or the whole cache if path is None.
+
+    Input: cache_dir, path (optional) of the instrument file
+    """
+    if not os.path.isdir(cache_dir):
+        return
+
+    index = load_index(cache_dir)
+
+    if path is None:
+        keys = set(record["hash"] for record in index.values())
+        index = {}
+    else:
+        record = index.pop(os.path.abspath(path), None)
+        keys = set() if record is None else {record["hash"]}
+        # content shared with another file on record stays cached
+        keys -= set(record["hash"] for record in index.values())
+
+    for i in os.listdir(cache_dir):
+        if not i.endswith((".parquet", ".pkl")):
+            continue
+        if path is None or i.split("_")[0] in keys:
+            os.remove(os.path.join(cache_dir, i))
+
+    save_index(cache_dir, index)
+
+def cache_evict(cache_dir, max_bytes=2 * 1024 ** 3, extensions=(".parquet", ".pkl")):
+    """
+    Evicts least recently used entries until the cache is no larger than max_bytes.
+
+    Input: cache_dir, max_bytes (int, default 2 GB), extensions - tuple, file endings of the cache entries
+    Return: int, number of entries removed
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    entries = []
+    for i in os.scandir(cache_dir):
+        if i.is_file() and i.name.endswith(extensions):
+            stat = i.stat()
+            entries.append((stat.st_mtime, stat.st_size, i.path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, entry in sorted(entries):  # oldest first
+        if total <= max_bytes:
+            break
+        os.remove(entry)
+        total -= size
+        removed += 1
+
+    return removed
@@ -0,0 +1,214 @@
+import pandas as pd
+import numpy as np
+import itertools
+import re
+
+# reactor part at the start of a sample ID: r or R, optional space, digits ("R0012", "r15", "R 0012")
+reactor_token = re.compile("[Rr] ?[0-9]+")
+
+
+def normalize_ids(ids, width=5):
+    """
+    Shortens sample IDs to their first characters (reactor ID, R####). The string work is done once per unique ID
+    and mapped back to the rows, not once per row.
+
+    Input: ids - series of sample IDs, width - int, number of characters kept (None keeps the full ID)
+    Return: series of normalized IDs, same index as ids
+    """
+    codes, uniques = pd.factorize(ids)
+    if width is not None:
+        uniques = pd.Index(uniques).str.slice(0, width)
+    values = np.asarray(uniques, dtype=object).take(codes) if len(uniques) else np.full(len(codes), np.nan, dtype=object)
+    values[codes < 0] = np.nan
+    return pd.Series(values, index=ids.index, name=ids.name)
+
+def match_ids(ids, pattern):
+    """
+    Regex match of sample IDs (re.match semantics, as pandas str.match), evaluated once per unique ID.
+
+    Input: ids - series of sample IDs, pattern - compiled regex or str
+    Return: numpy bool array, True where the ID matches. Missing IDs never match
+    """
+    codes, uniques = pd.factorize(ids)
+    matched = pd.Series(uniques, dtype=object).str.match(pattern).fillna(False).to_numpy(dtype=bool)
+    result = np.zeros(len(codes), dtype=bool)
+    result[codes >= 0] = matched[codes[codes >= 0]]
+    return result
+
+def build_reactor_index(ids, width=None):
+    """
+    Builds a reusable index of reactor IDs: normalized IDs as integer codes plus the row positions of every reactor.
+    Build it once on a dataframe and pass it to the functions that filter or group by reactor, so they only touch the
+    rows of the selected reactors.
+
+    The index refers to row positions, rebuild it if the dataframe is filtered or re-sorted.
+
+    Input: ids - series of sample IDs (e.g. df["Sample ID"])
+           width - int, IDs are shortened to this many characters (see normalize_ids). Default keeps full IDs
+    Return: dictionary
+        "keys": numpy array of reactor IDs, sorted. code = position in keys
+        "codes": reactor code of every row, -1 where the ID is missing
+        "order": row positions sorted by code (row order kept within a reactor)
+        "offsets": rows of reactor code k are order[offsets[k]:offsets[k + 1]]
+        "lookup": dictionary, reactor ID -> code
+        "n": number of rows the index was built on
+    """
+    codes, keys = pd.factorize(ids, sort=True)
+    keys = np.asarray(keys, dtype=object)
+
+    if width is not None and len(keys):
+        # shortening can merge IDs, re-coding on the shortened unique IDs only
+        short_codes, keys = pd.factorize(pd.Index(keys).str.slice(0, width), sort=True)
+        keys = np.asarray(keys, dtype=object)
+        codes = np.where(codes >= 0, short_codes[codes], -1)
+
+    order = np.argsort(codes, kind="stable")
+    order = order[np.searchsorted(codes[order], 0):]  # rows without an ID are not part of any reactor
+    offsets = np.searchsorted(codes[order], np.arange(len(keys) + 1))
+
+    return {"keys": keys,
+            "codes": codes,
+            "order": order,
+            "offsets": offsets,
+            "lookup": {key: i for i, key in enumerate(keys)},
+            "n": len(codes)}
+
+def index_rows(index, biorx_list):
+    """
+    Row positions of the selected reactors, grouped by reactor in sorted ID order. IDs not in the index are skipped.
+
+    Input: index (build_reactor_index), biorx_list - list of reactor IDs
+    Return: numpy array of row positions
+    """
+    codes = sorted(set(index["lookup"][i] for i in biorx_list if i in index["lookup"]))
+    offsets = index["offsets"]
+    if not codes:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([index["order"][offsets[i]:offsets[i + 1]] for i in codes])
+
+def index_groups(index, biorx_list=None):
+    """
+    Row positions per reactor, in sorted ID order.
+
+    Input: index (build_reactor_index), biorx_list (optional) - list of reactor IDs, default every reactor
+    Return: list of tuples (reactor ID, numpy array of row positions)
+    """
+    if biorx_list is None:
+        codes = range(len(index["keys"]))
+    else:
+        codes = sorted(set(index["lookup"][i] for i in biorx_list if i in index["lookup"]))
+    offsets = index["offsets"]
+    return [(index["keys"][i], index["order"][offsets[i]:offsets[i + 1]]) for i in codes]
+
+def select_reactors(df, biorx_list, index=None, column="Sample ID"):
+    """
+    Rows of df belonging to the reactors in biorx_list, grouped by reactor in sorted ID order (same order groupby
+    would visit them).
+
+    Input: df, biorx_list, index (optional) - build_reactor_index on df[column]. Built on the fly if not given or if it
+           was built on a dataframe of a different length
+    Return: dataframe
+    """
+    if index is None or index["n"] != df.shape[0]:
+        index = build_reactor_index(df[column])
+    return df.iloc[index_rows(index, biorx_list)]
+
+def split_reactors(df, column="Sample ID"):
+    """
+    Splits a dataframe whose rows are already grouped by reactor (select_reactors) into one dataframe per reactor,
+    without re-grouping: only the boundaries between consecutive reactors are looked up.
+
+    Return: list of tuples (reactor ID, dataframe)
+    """
+    ids = df[column].to_numpy()
+    if len(ids) == 0:
+        return []
+    starts = np.concatenate([[0], np.flatnonzero(ids[1:] != ids[:-1]) + 1, [len(ids)]])
+    return [(ids[starts[i]], df.iloc[starts[i]:starts[i + 1]]) for i in range(len(starts) - 1)]
+
+def edit_distance(a, b):
+    """
+    Levenshtein distance between 2 strings (insertions, deletions, substitutions)
+    """
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+def _deletes(word, max_distance):
+    """
+    Every string left after deleting up to max_distance characters from word, word included
+    """
+    variants = {word}
+    for n in range(1, min(max_distance, len(word)) + 1):
+        for positions in itertools.combinations(range(len(word)), n):
+            variants.add("".join(c for i, c in enumerate(word) if i not in positions))
+    return variants
+
+def build_delete_index(known, max_distance=2):
+    """
+    Symmetric delete index of known IDs: every deletion variant of every ID -> IDs it came from. 2 IDs within
+    max_distance edits share a variant, so candidates for a query are found by looking up the query's own deletion
+    variants, without comparing it to every known ID.
+
+    Input: known - list of IDs (e.g. reactor IDs R####), max_distance - int
+    Return: dictionary, "max_distance", "variants" (variant -> set of known IDs)
+    """
+    variants = {}
+    for i in set(known):
+        for j in _deletes(i, max_distance):
+            variants.setdefault(j, set()).add(i)
+    return {"max_distance": max_distance, "variants": variants}
+
+def lookup_ids(delete_index, word):
+    """
+    Known IDs within max_distance edits of word (build_delete_index)
+
+    Return: dictionary, known ID -> edit distance
+    """
+    candidates = set()
+    for i in _deletes(word, delete_index["max_distance"]):
+        candidates.update(delete_index["variants"].get(i, ()))
+    distances = {i: edit_distance(word, i) for i in candidates}
+    return {i: d for i, d in distances.items() if d <= delete_index["max_distance"]}
+
+def suggest_ids(ids, known, max_distance=2, ambiguous=None):
+    """
+    Suggests corrections of mistyped sample IDs, as a dict_change for rename_flex_sample_id (BSRmerge).
+    The reactor part of every unique ID (reactor_token, compared upper case) that is not a known reactor ID is looked
+    up in a symmetric delete index of the known IDs. The closest known ID within max_distance edits is suggested, with
+    the rest of the sample ID kept ("r15 GLUC" -> "R0015 GLUC"). IDs with 2 or more equally close known IDs are not
+    suggested.
+
+    Input: ids - series or list of sample IDs (e.g. df_flx["Flex Sample ID"])
+           known - list of known reactor IDs (e.g. df_vcl["Vicell Sample ID"].unique())
+           max_distance - int, maximum number of edits
+           ambiguous (optional) - dictionary, filled with sample ID: list of equally close known IDs
+    Return: dictionary, key = corrected sample ID, value = list of sample IDs to rename
+    """
+    known = [i for i in pd.unique(pd.Series(known, dtype=object).dropna())]
+    D_upper = {i.upper(): i for i in known}
+    delete_index = build_delete_index(list(D_upper), max_distance)
+
+    dict_change = {}
+    for i in pd.unique(pd.Series(ids, dtype=object).dropna()):
+        token = reactor_token.match(i)
+        if token is None or token.group() in known:
+            continue
+        distances = lookup_ids(delete_index, token.group().upper())
+        if not distances:
+            continue
+        best = min(distances.values())
+        L_best = sorted(D_upper[j] for j, d in distances.items() if d == best)
+        if len(L_best) > 1:
+            if ambiguous is not None:
+                ambiguous[i] = L_best
+            continue
+        correct = L_best[0] + i[token.end():]
+        if correct != i:
+            dict_change.setdefault(correct, []).append(i)
+
+    return dict_change
@@ -0,0 +1,176 @@
+import pandas as pd
+import os
+import json
+import time
+import datetime
+import functools
+import itertools
+import tracemalloc
+import cProfile
+
+# instrumentation settings
+#   enabled - record every stage call (wall time, rows in/out, rejected rows)
+#   memory  - also record peak memory with tracemalloc (slows python code down while it runs)
+#   profile - also run every stage under cProfile, stats are written to profile_dir as <function>_<pid>_<n>.prof
+#   max_records - only the last max_records stage calls are kept, so a long running process (BSRwatch) doesn't grow
+settings = {"enabled": True, "memory": False, "profile": False, "profile_dir": ".bsr_profile", "max_records": 10000}
+
+# one record per stage call, in call order. Reset with reset_records
+stage_records = []
+
+_profiling = False  # cProfile can't nest, stages called from inside a profiled stage are not profiled again
+
+_active = []  # stages running right now. A stage calling another function of the same stage is recorded once
+
+_profile_count = itertools.count()  # numbers profile files, stage_records is capped and reset so its length repeats
+
+
+def instrument_config(**kwargs):
+    """
+    Changes instrumentation settings, e.g. instrument_config(memory=True, profile=True)
+
+    Return: dictionary, current settings
+    """
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError("unknown instrumentation setting: " + key)
+        settings[key] = value
+    return dict(settings)
+
+def reset_records():
+    del stage_records[:]
+
+def add_records(records):
+    """
+    Appends stage records made elsewhere (worker processes) to stage_records, keeping the last max_records
+    """
+    stage_records.extend(records)
+    if len(stage_records) > settings["max_records"]:
+        del stage_records[:len(stage_records) - settings["max_records"]]
+
+def count_rows(value):
+    """
+    Rows held by a stage input or output: a dataframe, or a dictionary of dataframes (one per file).
+    None for anything else
+    """
+    if isinstance(value, pd.DataFrame):
+        return value.shape[0]
+    if isinstance(value, dict):
+        frames = [i for i in value.values() if isinstance(i, pd.DataFrame)]
+        if frames:
+            return sum(i.shape[0] for i in frames)
+    return None
+
+def dropped(rows_in, rows_out):
+    """
+    Rejected rows of a stage that filters or de-duplicates: rows in - rows out
+    """
+    if rows_in is None or rows_out is None:
+        return None
+    return rows_in - rows_out
+
+def stage(name, data_arg=0, rejected=None):
+    """
+    Decorator recording a pipeline stage. Every call appends a record to stage_records:
+    stage, function, start, seconds, rows_in, rows_out, rejected, peak_mb (memory setting), profile (profile setting)
+
+    Input: name - stage name (convert, check_format, clean, merge, rename, join, runtime, qp, plot)
+           data_arg - position (int) or name (str) of the argument holding the stage input data, or a tuple of them
+                      (rows are added up)
+           rejected - function (rows_in, rows_out) -> rejected rows, e.g. dropped. Default not recorded
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global _profiling
+            if not settings["enabled"] or name in _active:
+                return func(*args, **kwargs)
+
+            # counted before the call, some stages change their input in place
+            rows_in = None
+            for i in (data_arg if isinstance(data_arg, (tuple, list)) else [data_arg]):
+                rows = count_rows(args[i] if isinstance(i, int) and len(args) > i else kwargs.get(i, None))
+                if rows is not None:
+                    rows_in = rows if rows_in is None else rows_in + rows
+
+            record = {"stage": name, "function": func.__name__,
+                      "start": datetime.datetime.now().isoformat(timespec="milliseconds")}
+
+            # memory: started here unless an enclosing stage is already tracing
+            trace = settings["memory"] and not tracemalloc.is_tracing()
+            if trace:
+                tracemalloc.start()
+            profiler = None
+            if settings["profile"] and not _profiling:
+                profiler = cProfile.Profile()
+                _profiling = True
+                profiler.enable()
+
+            _active.append(name)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                record["seconds"] = time.perf_counter() - start
+                _active.pop()
+                if profiler is not None:
+                    profiler.disable()
+                    _profiling = False
+                if settings["memory"] and tracemalloc.is_tracing():
+                    record["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+                if trace:
+                    tracemalloc.stop()
+
+            record["rows_in"] = rows_in
+            record["rows_out"] = count_rows(result)
+            record["rejected"] = rejected(rows_in, record["rows_out"]) if rejected is not None else None
+
+            if profiler is not None:
+                os.makedirs(settings["profile_dir"], exist_ok=True)
+                path = os.path.join(settings["profile_dir"], "%s_%d_%d.prof" % (func.__name__, os.getpid(),
+                                                                                 next(_profile_count)))
+                profiler.dump_stats(path)
+                record["profile"] = path
+
+            add_records([record])
+            return result
+        return wrapper
+    return decorator
+
+def stage_table(records=None):
+    """
+    Stage records as a dataframe, one row per call
+    """
+    if records is None:
+        records = stage_records
+    return pd.DataFrame(records, columns=["stage", "function", "start", "seconds", "peak_mb", "rows_in", "rows_out",
+                                          "rejected", "profile"])
+
+def stage_report(records=None):
+    """
+    Prints the recorded stages and where the time went, per stage
+
+    Return: dataframe, total seconds and calls per stage
+    """
+    df = stage_table(records)
+
+    print("#### Stage Report ####")
+    print("\n")
+    print(df.drop(columns=["start", "profile"]).to_string(index=False))
+    print("\n")
+
+    summary = df.groupby("stage", sort=False).agg(calls=("function", "size"), seconds=("seconds", "sum"))
+    summary["share"] = summary["seconds"] / max(summary["seconds"].sum(), 1e-12)
+    print(summary.to_string())
+
+    return summary
+
+def export_json(path, records=None):
+    """
+    Writes the stage records to a JSON file: {"records": [...]} with one entry per stage call
+    """
+    if records is None:
+        records = stage_records
+    with open(path, "w") as f:
+        json.dump({"records": records}, f, indent=2)
+    return path
@@ -0,0 +1,148 @@
+import pandas as pd
+import numpy as np
+
+from BSRinstrument import stage
+
+# specific rate columns: species column -> factor from (species unit / 10E6 cells/mL day) to the reported unit
+#   g/L    / (10E6 cells/mL day) = 1000 pg/cell day
+#   mmol/L / (10E6 cells/mL day) = 1 pmol/cell day
+species_factors = {"Gluc": 1000, "Lac": 1000, "Gln": 1, "NH4+": 1}
+
+
+def _segments(codes):
+    """
+    Lays out rows that are already sorted by group code as segments.
+
+    Input: codes - numpy array of group codes, sorted
+    Return: start - bool array, True on the first row of every segment
+    """
+    start = np.ones(len(codes), dtype=bool)
+    start[1:] = codes[1:] != codes[:-1]
+    return start
+
+def _segmented_cumsum(values, start):
+    """
+    Running total restarting at every segment, skipping NaN like pandas cumsum (NaN stays NaN in the result).
+    Every segment is accumulated on its own, from 0, so its totals don't carry the rounding of earlier segments.
+    """
+    if len(values) == 0:
+        return values.copy()
+
+    nan = np.isnan(values)
+    segments = np.split(np.where(nan, 0, values), np.flatnonzero(start)[1:])
+    result = np.concatenate([np.cumsum(i) for i in segments])
+    result[nan] = np.nan
+    return result
+
+def _layout(df, mask):
+    """
+    Selects rows where mask is True and a Sample ID is present, sorted by Sample ID (order within a Sample ID is kept).
+
+    Return: tuple (rows, start), rows = positional index into df, start = first row of every Sample ID
+    """
+    codes = pd.factorize(df["Sample ID"])[0]
+    rows = np.flatnonzero(mask & (codes >= 0))
+    rows = rows[np.argsort(codes[rows], kind="stable")]
+    return rows, _segments(codes[rows])
+
+def _diff(values, start):
+    """
+    Difference to the previous row of the same segment, NaN on the first row of each segment
+    """
+    result = np.empty_like(values)
+    result[1:] = values[1:] - values[:-1]
+    result[start] = np.nan
+    return result
+
+@stage("qp")
+def calc_kinetics(df, species=("Gluc", "Lac", "Gln", "NH4+")):
+    """
+    Computes growth and productivity kinetics for every reactor in one pass. Rows are grouped by "Sample ID", and
+    rows keep their existing order within a Sample ID (calc_runtime output is chronological).
+
+    Must contain columns: ["Sample ID", "Runtime", "VCD", "Titer"] and every column in species.
+
+    New columns:
+    IVCD    - integral of viable cell density (trapezoid rule) in units of 10E6 cells/mL day, on rows with a VCD
+    Qp      - cell specific productivity in units of pg/cell day, Titer / IVCD (same as calc_qp)
+    mu      - specific growth rate in units of 1/day, ln(VCD) difference between consecutive VCD samples / time
+    q <species> - specific production rate, species difference / IVCD difference between consecutive rows where both
+              VCD and the species were measured. Negative values are consumption.
+              pg/cell day for g/L species (Gluc, Lac), pmol/cell day for mmol/L species (Gln, NH4+)
+
+    PARAMETERS
+
+    df: datframe input
+    species: columns to compute specific rates for
+
+    RETURN
+
+    df: original dataframe is returned with the additional columns.
+    """
+
+    vcd = df["VCD"].to_numpy(dtype=float)
+    runtime = df["Runtime"].to_numpy(dtype=float)
+    titer = df["Titer"].to_numpy(dtype=float)
+
+    ivcd = np.full(df.shape[0], np.nan)
+    qp = np.full(df.shape[0], np.nan)
+    mu = np.full(df.shape[0], np.nan)
+
+    #### IVCD, Qp and mu over rows with a VCD value ####
+    rows, start = _layout(df, ~np.isnan(vcd))
+
+    v = vcd[rows]
+    t = runtime[rows]
+    time_delta = _diff(t, start)  # getting time delta (x axis delta)
+    vcd_shift = np.full_like(v, np.nan)  # shifting VCD to do Yn + Y(n-1) for every row
+    vcd_shift[1:] = v[:-1]
+    trapezoids = (v + vcd_shift) * time_delta / 2  # area of each trapezoid, Nan at the start of each Sample ID
+
+    ivcd[rows] = _segmented_cumsum(trapezoids, start)  # integrated area in units 10E6 cells/mL * days
+    qp[rows] = titer[rows] * (10 ** 9) / (ivcd[rows] * (10 ** 6))  # titer in pg/ml over IVCD in cells/mL day
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mu[rows] = _diff(np.log(v), start) / time_delta
+
+    df["IVCD"] = ivcd
+    df["Qp"] = qp
+    df["mu"] = mu
+
+    # IVCD is zero (not Nan) at the first sample of each reactor when differencing for specific rates
+    ivcd = ivcd.copy()
+    ivcd[rows[start]] = 0
+
+    #### specific rates, consecutive rows with both VCD and species measured ####
+    for i in species:
+        conc = df[i].to_numpy(dtype=float)
+        q = np.full(df.shape[0], np.nan)
+
+        rows, start = _layout(df, ~np.isnan(vcd) & ~np.isnan(conc))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            q[rows] = _diff(conc[rows], start) / _diff(ivcd[rows], start) * species_factors.get(i, 1)
+
+        df["q " + i] = q
+
+    return df
+
+@stage("qp")
+def calc_qp(df):
+    """
+    Calculates Cell Specific Productivity in units of pg/cell day and inserts result into a new column "Qp".
+    Must contain columns: ["Sample ID", "Runtime", "VCD", "Titer"]
+
+    PARAMETERS
+
+    df: datframe input
+
+
+    RETURN
+
+    df: original dataframe is returned with additional column, "Qp".
+
+
+    """
+    qp = calc_kinetics(df[["Sample ID", "Runtime", "VCD", "Titer"]].copy(), species=())["Qp"]
+    df["Qp"] = qp.to_numpy()
+
+    return df
@@ -1,20 +1,104 @@
 import pandas as pd
 from os import listdir
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import datetime
 import re
+import itertools
 import numpy as np
 
+from BSRcache import cache_load, cache_store, cache_evict, load_index, save_index
+from BSRkinetics import calc_qp, calc_kinetics
+from BSRindex import normalize_ids, match_ids
+from BSRinstrument import stage, dropped
 
-def vicell_convert_xlsx():
+# FLEX columns kept after format check, everything else in the export is dropped
+flex_columns = ['Sample ID', 'Date & Time', 'Gln', 'Glu', 'Gluc', 'Lac', 'NH4+', 'Na+', 'K+', 'Ca++', 'pH', 'PO2',
+                'PCO2', 'O2 Saturation', 'Osm', 'Vessel Temperature (°C)', 'Chemistry Dilution Ratio', 'HCO3']
+
+# dtypes declared up front for the FLEX reader, every analyte is numeric
+flex_dtypes = {i: "float64" for i in flex_columns[2:]}
+flex_dtypes["Sample ID"] = str
+
+# versions of the cached parsing stages, part of the cache entry name. Bump when a reader or what it returns changes,
+# so entries written by the previous reader are parsed again instead of being served
+vicell_cache_version = 1  # vicell_read_xlsx
+flex_cache_version = 2  # flex_read_csv + flex_check_format. 2: dates parsed during the read, declared dtypes
+
+# ViCell header cells checked before the body of an export is read: (sheet row, column) -> value. Sheet rows count
+# from the first row of the sheet, i.e. vicell_check_format's df.iloc row + 1
+vicell_header_cells = {(3, 0): "Bioprocess:", (4, 1): "File name", (4, 2): "Cell type", (4, 4): "Sample date/time",
+                       (4, 7): "Viability", (5, 7): "(%)", (4, 9): "Viable cells", (5, 9): "/ml (x10^6)"}
+vicell_header_numbers = [0, 1, 2, 10, 11, 12, 13, 14, 15, 16]  # sheet row 6, columns 0-9
+
+
+def _read_file(reader, filename):
     """
-    Converts all .xlsx files in present working directory
+    Reads a single instrument file into a dataframe. Runs inside the worker pool, so failures are caught here
+    and returned as None to keep one bad file from taking down the whole import.
 
-    Return: Dictionary. Keys = filename.xlsx, values = Dataframe
+    Input: reader function (pd.read_excel, vicell_read_xlsx or flex_read_csv), filename
+    Return: tuple of (filename, dataframe or None, error message or None)
+    """
+    try:
+        return filename, reader(filename), None
+    except Exception as e:
+        return filename, None, str(e)
+
+def _list_files(directory, extension):
+    """
+    Files ending in extension, in directory (None = present working directory). Files in the present working directory
+    are listed by name, files in another directory by their path.
+
+    Return: list of file names/paths
+    """
+    L_files = [i for i in listdir(directory) if i[-len(extension):] == extension]
+    if directory is None:
+        return L_files
+    return [os.path.join(directory, i) for i in L_files]
+
+def _convert_files(L_files, reader, workers=None, D_errors=None):
+    """
+    Converts a list of files into dataframes, either one after another or spread across a pool of worker processes.
+
+    Input: list of filenames, reader function, workers (int, number of processes. None or 1 = no pool),
+           D_errors (optional) - dictionary, filled with filename: error message of the files that failed
+    Return: Dictionary. Keys = filename, values = Dataframe
+    """
+    if workers is not None and workers > 1 and len(L_files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_read_file, [reader] * len(L_files), L_files))
+    else:
+        results = [_read_file(reader, i) for i in L_files]
+
+    # results come back in the same order as L_files, so the dictionary order matches the serial import
+    D_df = {}
+    for i, df, error in results:
+        if df is not None:
+            D_df[i] = df
+            print(i + ": " + "CONVERTED")
+        else:
+            print("Failed to convert the following file into pandas dataframe: " + str(i))
+            if D_errors is not None:
+                D_errors[i] = error
+
+    return D_df
+
+
+@stage("convert", data_arg=None)
+def vicell_convert_xlsx(workers=None, directory=None):
+    """
+    Converts all .xlsx files in present working directory, or in directory
+
+    Input: workers (optional) - int, number of processes used to parse files in parallel. Default parses serially.
+           directory (optional) - str, directory of the ViCell exports. Default present working directory
+    Return: Dictionary. Keys = filename.xlsx (path when directory is given), values = Dataframe
     """
 
     #### Listing all files in directory ####
-    files_list = listdir()  # list of all files in pwd
-    L_xlsx = [i for i in files_list if i[-4:] == "xlsx"]  # isolating files that end in "xlsx"
+    L_xlsx = _list_files(directory, "xlsx")  # isolating files that end in "xlsx"
     print("####   ViCell Import Report ####")
     print("\n")
     print("Total number of .xlsx files in dir: " + str(len(L_xlsx)))
@@ -25,17 +109,11 @@ def vicell_convert_xlsx():
 
     # importing all .xlsx files into dataframes
     print("Converting excel files into DataFrames: ")
-    D_df = {}
-    for i in L_xlsx:
-        try:
-            df = pd.read_excel(i)
-            D_df[i] = df
-            print(i + ": " + "CONVERTED")
-        except:
-            print("Failed to convert the following file into pandas dataframe: " + str(i))
+    D_df = _convert_files(L_xlsx, pd.read_excel, workers)
 
     return D_df
 
+@stage("check_format")
 def vicell_check_format(D_df):
     """
     Checking for ViCell data format consitency
@@ -66,6 +144,7 @@ def vicell_check_format(D_df):
         else:
             print(key + ": " + "FAILED to confirm ViCell Format")
 
+@stage("clean")
 def vicell_clean(D_df):
     """
     Cleans up data from dataframe that is confirmed to have ViCell format from .xlsx file.
@@ -112,27 +191,235 @@ def vicell_clean(D_df):
         df["Sample ID"] = df["Sample ID"].str.slice(0, 5)  # shortening Sample ID colum to first 4 characters
         df["File name"] = df["File name"].str.slice(0, 5)  # shortening "File name" column
 
-        # verify that Sample ID column = File name column
-        unequal_id = df["Sample ID"] != df["File name"]
-        L_unequal = list(df[unequal_id].index)
+        _vicell_clean_report(key, df)
 
-        print(key + "-------- Data Cleaning Complete")
+    return D_df
 
-        if not L_unequal:
-            print("All Sample ID's match File name")
-        else:
-            print("WARNING! Sample ID does not match File name for the following indeces: " + str(L_unequal))
+def _vicell_clean_report(key, df):
+    """
+    Prints the cleaning checks of one ViCell file: Sample ID matches File name, every sample is CHO
+    """
+    # verify that Sample ID column = File name column
+    unequal_id = df["Sample ID"] != df["File name"]
+    L_unequal = list(df[unequal_id].index)
+
+    print(key + "-------- Data Cleaning Complete")
+
+    if not L_unequal:
+        print("All Sample ID's match File name")
+    else:
+        print("WARNING! Sample ID does not match File name for the following indeces: " + str(L_unequal))
+
+    # verify that all "Cell type = "CHO"
+    L_notCHO = list(df[df["Cell type"] != "CHO"].index)
 
-        # verify that all "Cell type = "CHO"
-        L_notCHO = list(df[df["Cell type"] != "CHO"].index)
+    if not L_notCHO:
+        print("All samples are of type: CHO")
+    else:
+        print("WARNING! Cell type is not CHO at the following index: " + str(L_notCHO))
 
-        if not L_notCHO:
-            print("All samples are of type: CHO")
+def _vicell_header_ok(header):
+    """
+    ViCell format check (same checks as vicell_check_format) on the first 7 rows of a sheet
+
+    Input: list of row tuples, as read from the sheet
+    Return: bool
+    """
+    if len(header) < 7:
+        return False
+    cell = lambda row, clm: header[row][clm] if clm < len(header[row]) else None
+
+    title = cell(0, 0)
+    return (
+            isinstance(title, str) and title[0:7] == "Vi-CELL" and
+            all(cell(row, clm) == value for (row, clm), value in vicell_header_cells.items()) and
+            [cell(6, i) for i in range(10)] == vicell_header_numbers
+    )
+
+def _vicell_column(values):
+    """
+    One ViCell body column as a typed series: numbers -> int/float, dates -> datetime64, anything else (or a mix)
+    -> object. Empty cells are NaN
+    """
+    if not values:
+        return pd.Series([], dtype=object)
+    return pd.Series([np.nan if i is None else i for i in values])
+
+def vicell_read_xlsx(filename):
+    """
+    Reads a ViCell export straight into its cleaned form (vicell_check_format + vicell_clean in one pass).
+    The sheet is streamed: the header is checked on the first rows and a file that is not a ViCell export is
+    rejected before its body is read. The column names are combined from the 2 header rows as they are read,
+    and the body is read straight into typed columns, Sample ID and File name shortened to 5 characters.
+
+    Input: filename (.xlsx)
+    Return: dataframe, same columns and values as vicell_clean
+    Raises ValueError when the file fails the ViCell format check
+    """
+    import openpyxl  # the .xlsx engine of pd.read_excel, only needed for ViCell exports
+
+    wb = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+
+        header = list(itertools.islice(rows, 7))
+        if not _vicell_header_ok(header):
+            raise ValueError("FAILED to confirm ViCell Format")
+
+        # column names split over 2 rows by ViCell: combined when both rows hold a string
+        combined = [i + j if isinstance(i, str) and isinstance(j, str) else i
+                    for i, j in itertools.zip_longest(header[4], header[5])]
+
+        # trailing empty cells and empty rows are dropped, the way pd.read_excel reads the sheet
+        body = []
+        width = len(combined)
+        for row in rows:
+            row = list(row)
+            while row and row[-1] is None:
+                row.pop()
+            body.append(row)
+            width = max(width, len(row))
+    finally:
+        wb.close()
+
+    while body and not body[-1]:
+        body.pop()
+
+    combined = [np.nan if i is None else i for i in combined] + [np.nan] * (width - len(combined))
+    body = [i + [None] * (width - len(i)) for i in body]
+    columns = list(zip(*body)) if body else [()] * width
+
+    df = pd.concat([_vicell_column(i) for i in columns], axis=1, ignore_index=True)
+    df.columns = combined
+
+    # Shortening column data into the first 5 characters: Sample ID, File name
+    df["Sample ID"] = df["Sample ID"].astype(object).str.slice(0, 5)
+    df["File name"] = df["File name"].astype(object).str.slice(0, 5)
+
+    return df
+
+@stage("convert", data_arg=None)
+def vicell_convert_clean(workers=None, directory=None):
+    """
+    Streaming equivalent of vicell_convert_xlsx -> vicell_check_format -> vicell_clean for all .xlsx files in present
+    working directory, or in directory (see vicell_read_xlsx). Files failing the format check are left out.
+
+    Input: workers (optional) - int, number of processes used to parse files in parallel. Default parses serially.
+           directory (optional) - str, directory of the ViCell exports. Default present working directory
+    Return: Dictionary. Keys = filename.xlsx (path when directory is given), values = cleaned Dataframe
+    """
+    L_xlsx = _list_files(directory, "xlsx")  # isolating files that end in "xlsx"
+    print("####   ViCell Import Report ####")
+    print("\n")
+    print("Total number of .xlsx files in dir: " + str(len(L_xlsx)))
+    print("List of .xlsx files: " + str(L_xlsx))
+    print("\n")
+
+    print("Converting excel files into DataFrames: ")
+    D_errors = {}
+    D_df = _convert_files(L_xlsx, vicell_read_xlsx, workers, D_errors)
+
+    print("\n")
+    print("#### ViCell Format Report ####")
+    print("\n")
+    print("Total files to verify: " + str(L_xlsx))
+    for key in L_xlsx:
+        if key in D_df:
+            print(key + ": " + "CONFIRMED")
         else:
-            print("WARNING! Cell type is not CHO at the following index: " + str(L_notCHO))
+            print(key + ": " + str(D_errors[key]))
+
+    print("\n")
+    print("#### ViCell Data Cleaning Report ####")
+    print("\n")
+    for key, df in D_df.items():
+        _vicell_clean_report(key, df)
 
     return D_df
 
+def _import_cached(L_files, cache_dir, stage, convert, max_bytes):
+    """
+    Loads each file from the parsed-file cache, parses only the files that missed, and stores their results.
+
+    Input: list of filenames, cache_dir, stage (cache entry name), convert (function: dict of misses -> dict of
+           parsed dataframes, only files that parsed correctly are returned), max_bytes (cache size limit)
+    Return: Dictionary. Keys = filename, values = Dataframe, in the order of L_files
+    """
+    index = load_index(cache_dir)
+
+    D_df = {}
+    L_miss = []
+    for i in L_files:
+        df = cache_load(cache_dir, i, stage, index)
+        if df is None:
+            L_miss.append(i)
+        else:
+            D_df[i] = df
+
+    print("Loaded from cache: " + str(list(D_df.keys())))
+    print("Parsing: " + str(L_miss))
+    print("\n")
+
+    if L_miss:
+        D_new = convert(L_miss)
+        for key, df in D_new.items():
+            cache_store(cache_dir, key, stage, df, index)
+        D_df.update(D_new)
+        cache_evict(cache_dir, max_bytes)
+
+    save_index(cache_dir, index)
+
+    return {i: D_df[i] for i in L_files if i in D_df}
+
+def vicell_import_cached(cache_dir=".bsr_cache", workers=None, max_bytes=2 * 1024 ** 3, directory=None):
+    """
+    Cached equivalent of vicell_convert_xlsx -> vicell_check_format -> vicell_clean for all .xlsx files in present
+    working directory. Files that are unchanged since the last run (same path, size, mtime and content hash) are
+    loaded from the cache, only new or modified files are parsed and cleaned.
+
+    Input: cache_dir - directory of the cache
+           workers (optional) - int, number of processes used to parse files in parallel
+           max_bytes - int, cache size limit. Least recently used entries are evicted past this size
+           directory (optional) - str, directory of the exports. Default present working directory
+    Return: Dictionary. Keys = filename.xlsx, values = cleaned Dataframe
+    """
+    print("####   ViCell Cached Import Report ####")
+    print("\n")
+    L_xlsx = _list_files(directory, "xlsx")
+
+    def convert(L_miss):
+        # files failing the format check are rejected by vicell_read_xlsx, only ViCell exports are cached
+        D_df = _convert_files(L_miss, vicell_read_xlsx, workers)
+        for key, df in D_df.items():
+            _vicell_clean_report(key, df)
+        return D_df
+
+    return _import_cached(L_xlsx, cache_dir, "vicell_read_v" + str(vicell_cache_version), convert, max_bytes)
+
+def flex_import_cached(cache_dir=".bsr_cache", workers=None, max_bytes=2 * 1024 ** 3, directory=None):
+    """
+    Cached equivalent of flex_convert_csv -> flex_check_format for all .csv files in present working directory.
+    Files that are unchanged since the last run (same path, size, mtime and content hash) are loaded from the cache,
+    only new or modified files are parsed and checked.
+
+    Input: cache_dir - directory of the cache
+           workers (optional) - int, number of processes used to parse files in parallel
+           max_bytes - int, cache size limit. Least recently used entries are evicted past this size
+           directory (optional) - str, directory of the exports. Default present working directory
+    Return: Dictionary. Keys = filename.csv, values = Dataframe (bioreactor data)
+    """
+    print("####   FLEX Cached Import Report ####")
+    print("\n")
+    L_csv = _list_files(directory, "csv")
+
+    def convert(L_miss):
+        D_df = flex_check_format(_convert_files(L_miss, flex_read_csv, workers))
+        # files that failed the format check come back unconverted, those are not cached
+        return {key: df for key, df in D_df.items() if list(df.columns) == flex_columns}
+
+    return _import_cached(L_csv, cache_dir, "flex_check_format_v" + str(flex_cache_version), convert, max_bytes)
+
+@stage("merge", rejected=dropped)
 def vicell_merge_convert(D_df):
     """
     Merging all dataframes in a dictionary, converting datatypes (datetime), and isolating essential columns
@@ -175,16 +462,19 @@ def vicell_merge_convert(D_df):
 
     return df
 
-def flex_convert_csv():
+@stage("convert", data_arg=None)
+def flex_convert_csv(workers=None, chunksize=None, directory=None):
     """
-    Converts all .csv files in present working directory
+    Converts all .csv files in present working directory, or in directory, see flex_read_csv
 
-    Return: Dictionary. Keys = filename.csv, values = Dataframe
+    Input: workers (optional) - int, number of processes used to parse files in parallel. Default parses serially.
+           chunksize (optional) - int, number of rows parsed at a time for very large exports
+           directory (optional) - str, directory of the FLEX exports. Default present working directory
+    Return: Dictionary. Keys = filename.csv (path when directory is given), values = Dataframe
     """
 
     #### Listing all files in directory ####
-    files_list = listdir()  # list of all files in pwd
-    L_csv = [i for i in files_list if i[-3:] == "csv"]  # isolating files that end in "xlsx"
+    L_csv = _list_files(directory, "csv")  # isolating files that end in "csv"
     print("####   FlEX Import Report ####")
     print("\n")
     print("Total number of .csv files in dir: " + str(len(L_csv)))
@@ -195,17 +485,39 @@ def flex_convert_csv():
 
     # importing all .xlsx files into dataframes
     print("Converting .csv files into DataFrames: ")
-    D_df = {}
-    for i in L_csv:
-        try:
-            df = pd.read_csv(i)
-            D_df[i] = df
-            print(i + ": " + "CONVERTED")
-        except:
-            print("Failed to convert the following file into pandas dataframe: " + str(i))
+    D_df = _convert_files(L_csv, partial(flex_read_csv, chunksize=chunksize), workers)
 
     return D_df
 
+def flex_read_csv(filename, chunksize=None):
+    """
+    Reads a Nova FLEX export, loading only the columns in flex_columns. Analytes are read straight into float
+    columns and "Date & Time" is parsed during the read. The header is checked first: if any of flex_columns is
+    missing, only the header is returned (no rows) and flex_check_format reports the file as failed.
+
+    Input: filename, chunksize (optional) - int, number of rows parsed at a time for very large exports
+    Return: dataframe
+    """
+    header = pd.read_csv(filename, nrows=0)
+    if not set(flex_columns).issubset(header.columns):
+        return header
+
+    read = partial(pd.read_csv, filename, usecols=flex_columns, parse_dates=["Date & Time"], chunksize=chunksize)
+
+    try:
+        df = read(dtype=flex_dtypes)
+        if chunksize is not None:
+            df = pd.concat(df, ignore_index=True)
+    except ValueError:
+        # text in a numeric column (e.g. flagged results), falling back to coercing bad values to NaN
+        df = read(dtype={"Sample ID": str})
+        if chunksize is not None:
+            df = pd.concat(df, ignore_index=True)
+        df[flex_columns[2:]] = df[flex_columns[2:]].apply(pd.to_numeric, errors="coerce")
+
+    return df
+
+@stage("check_format", rejected=dropped)
 def flex_check_format(D_df):
     """
     Checking for flex data format consitency, and removing non-bioreactor data points.
@@ -219,10 +531,7 @@ def flex_check_format(D_df):
     print("Total files to verify: " + str(list(D_df.keys())))
     print("\n")
 
-    # Selecting wanted and unwanted columns
-    flex_columns = ['Sample ID', 'Date & Time', 'Gln', 'Glu', 'Gluc', 'Lac', 'NH4+', 'Na+', 'K+', 'Ca++', 'pH', 'PO2',
-                    'PCO2', 'O2 Saturation', 'Osm', 'Vessel Temperature (°C)', 'Chemistry Dilution Ratio', 'HCO3']
-
+    # Selecting wanted and unwanted columns (flex_columns, module level)
     for key, df in D_df.items():
         clms_lst = list(df.columns)  # extracting df columns as list
         test_list = [x for x in flex_columns if x in set(clms_lst)]  # test list: every item if it exists as a column
@@ -233,8 +542,9 @@ def flex_check_format(D_df):
             a = re.compile(
                 "[Rr][0-9][0-9]")  # expression to capture, letter r or R, followed by 2 numbers, followed by anything else
 
-            df_reject = df[~df["Sample ID"].str.match(a)].copy()  # ~ is the opposite of, rejected sample IDs
-            df = df[df["Sample ID"].str.match(a)].copy()  # accepted sample ID's
+            accepted = match_ids(df["Sample ID"], a)  # regex run once per unique sample ID
+            df_reject = df[~accepted].copy()  # ~ is the opposite of, rejected sample IDs
+            df = df[accepted].copy()  # accepted sample ID's
 
             D_df[key] = df.copy()
             print(str(key) + "----------" + "Converted Succesfully")  # printing accepted and rejected sample ID's
@@ -248,6 +558,7 @@ def flex_check_format(D_df):
 
     return D_df
 
+@stage("merge", rejected=dropped)
 def flex_merge(D_df):
     """
     Merging all dataframes in a dictionary, converting datatypes (datetime)
@@ -295,6 +606,7 @@ def flex_merge(D_df):
 
     return df
 
+@stage("rename", data_arg=1)
 def rename_flex_sample_id(dict_change, df):
     """
     Allows user to rename mislabled sample IDs.
@@ -302,55 +614,162 @@ def rename_flex_sample_id(dict_change, df):
 
     INPUTS:
     dict_change -  dictionary. key = "R0012" (correct value), value = ["R00120", "R012", "R00112"]
+                   suggest_ids (BSRindex) builds one from the known reactor IDs
     df - dataframe containing column "Sample ID". Values in this column will be changed.
+
+    The mapping is inverted once (correction_map) and applied to the unique sample IDs only, one pass over the rows.
     """
-    for key, value in dict_change.items():
-        id_match = df["Flex Sample ID"].isin(dict_change[key])
-        index = df[id_match].index
-        df.loc[index, "Flex Sample ID"] = key
+    D_map = correction_map(dict_change)
+    codes, uniques = pd.factorize(df["Flex Sample ID"])
+    renamed = np.array([D_map.get(i, i) for i in uniques], dtype=object)
+
+    if len(renamed) and (renamed != np.asarray(uniques, dtype=object)).any():
+        values = df["Flex Sample ID"].to_numpy(dtype=object, copy=True)
+        values[codes >= 0] = renamed[codes[codes >= 0]]
+        df["Flex Sample ID"] = values
 
     return df
 
-def merge_vcl_flx(df_vcl, df_flx):
+def correction_map(dict_change):
+    """
+    Inverts dict_change (correct ID: list of wrong IDs) into wrong ID: correct ID. The lists are applied in the order
+    of dict_change, as renaming one key after another would: an ID listed under several keys ends up under the last,
+    and a correct ID listed as wrong under a later key is renamed again.
+
+    Return: dictionary, wrong ID -> correct ID (IDs that end up unchanged are left out)
+    """
+    D_pos = {}  # wrong ID -> [(position of the key in dict_change, key)]
+    for n, (key, value) in enumerate(dict_change.items()):
+        for i in value:
+            D_pos.setdefault(i, []).append((n, key))
+
+    D_map = {}
+    for i in D_pos:
+        value, n = i, -1
+        while True:
+            nxt = next((j for j in D_pos.get(value, []) if j[0] > n), None)  # next rename of the current value
+            if nxt is None:
+                break
+            n, value = nxt
+        if value != i:
+            D_map[i] = value
+
+    return D_map
+
+def _nearest_positions(left_keys, left_times, right_keys, right_times, tolerance=None, direction="nearest"):
+    """
+    Nearest-timestamp match within groups, done as one sorted sweep over all groups at once.
+
+    Keys and timestamps of both sides are combined into a single sortable integer (group code, then dense rank of
+    the timestamp), so one binary search finds the previous and next right row of the same group for every left row.
+
+    Input: left_keys, right_keys - group labels (e.g. reactor ID), NaN never matches
+           left_times, right_times - datetime64 or float arrays, NaT/NaN never matches
+           tolerance (optional) - maximum distance, pd.Timedelta (datetimes) or float
+           direction - "nearest", "backward" (right time <= left time) or "forward" (right time >= left time)
+    Return: numpy array, for every left row the position of the matched right row, -1 if no match
     """
-    Joining vicell and flex dataframes. 2 merges are performed: merge_asof, followed by outer merge.
-    The data is grouped by Sample ID, then joined by nearest timestamp.
+    n_left = len(left_keys)
+    codes, uniques = pd.factorize(pd.concat([pd.Series(left_keys), pd.Series(right_keys)], ignore_index=True))
+    times = pd.concat([pd.Series(left_times), pd.Series(right_times)], ignore_index=True)
+
+    valid = (codes >= 0) & times.notna().to_numpy()
+    if np.issubdtype(times.dtype, np.datetime64):
+        times = times.to_numpy().view("int64")
+        if tolerance is not None:
+            tolerance = pd.Timedelta(tolerance).value
+    else:
+        times = times.to_numpy(dtype=float)
+
+    # combined key: code * (number of distinct times) + rank of time
+    ranks = np.zeros(len(times), dtype=np.int64)
+    unique_times, ranks[valid] = np.unique(times[valid], return_inverse=True)
+    combined = codes.astype(np.int64) * (len(unique_times) + 1) + ranks
+
+    left_comb, right_comb = combined[:n_left], combined[n_left:]
+    left_codes, right_codes = codes[:n_left], codes[n_left:]
+    left_t, right_t = times[:n_left], times[n_left:]
+    left_valid, right_valid = valid[:n_left], valid[n_left:]
+
+    right_rows = np.flatnonzero(right_valid)
+    right_rows = right_rows[np.argsort(right_comb[right_rows], kind="stable")]
+    sorted_comb = right_comb[right_rows]
+    sorted_codes = right_codes[right_rows]
+    n_right = len(right_rows)
+
+    # previous (backward) and next (forward) right row of the same group
+    back = np.searchsorted(sorted_comb, left_comb, side="right") - 1
+    fwd = np.searchsorted(sorted_comb, left_comb, side="left")
+    back_ok = left_valid & (back >= 0)
+    back_ok[back_ok] = sorted_codes[back[back_ok]] == left_codes[back_ok]
+    fwd_ok = left_valid & (fwd < n_right)
+    fwd_ok[fwd_ok] = sorted_codes[fwd[fwd_ok]] == left_codes[fwd_ok]
+
+    back_dist = np.full(n_left, np.inf)
+    fwd_dist = np.full(n_left, np.inf)
+    back_dist[back_ok] = left_t[back_ok] - right_t[right_rows[back[back_ok]]]
+    fwd_dist[fwd_ok] = right_t[right_rows[fwd[fwd_ok]]] - left_t[fwd_ok]
+
+    if direction == "backward":
+        use_back, dist = back_ok, back_dist
+    elif direction == "forward":
+        use_back, dist = np.zeros(n_left, dtype=bool), fwd_dist
+    elif direction == "nearest":
+        use_back = back_ok & (back_dist <= fwd_dist)  # ties go to the earlier sample, as merge_asof
+        dist = np.where(use_back, back_dist, fwd_dist)
+    else:
+        raise ValueError("direction must be 'nearest', 'backward' or 'forward'")
+
+    match = np.where(use_back, back, fwd)
+    ok = np.isfinite(dist)
+    if tolerance is not None:
+        ok &= dist <= tolerance
+
+    result = np.full(n_left, -1, dtype=np.int64)
+    result[ok] = right_rows[match[ok]]
+    return result
+
+@stage("join", data_arg=(0, 1))
+def merge_vcl_flx(df_vcl, df_flx, tolerance="30 minutes", direction="nearest"):
+    """
+    Joining vicell and flex dataframes: full outer join on nearest timestamp within each reactor.
+    Every ViCell sample is paired with the nearest FLEX sample of the same reactor (FLEX Sample ID shortened to the
+    first 5 characters) within tolerance, and FLEX samples that no ViCell sample was paired with are kept as rows of
+    their own. The join is one sorted sweep over all reactors, see _nearest_positions.
 
 
     INPUT: df_vcl, dataframe must contain columns: Vicell Sample ID, Vicell date/time
            df_flx, dataframe must contain columns: Flex Sample ID, Flex date/time
+           tolerance, maximum time between paired samples (str or pd.Timedelta, None = no limit). Default 30 minutes
+           direction, "nearest" (default), "backward" (FLEX sample at or before ViCell sample) or "forward"
 
-    Output: merged dataframe
+    Output: merged dataframe, sorted by datetime
     """
 
-    df_flx["Vicell Sample ID"] = df_flx["Flex Sample ID"].str.slice(0,
-                                                                    5)  # adding column to match Vicell file by (shortened flex Sample ID)
-    df_flx['Rank'] = df_flx['Flex date/time'].rank()  # dummy column for outer join
-
-    # left join on Vicell dataframe. merge_asof allows merging by closest values. will need outer join to get remainng right df data.
+    vcl_clms = ['Vicell Sample ID', 'Vicell date/time', 'Viability(%)', 'Viable cells/ml (x10^6)']
+    df_vcl = df_vcl[vcl_clms].reset_index(drop=True)
+    df_flx = df_flx.reset_index(drop=True)
 
-    merged = pd.merge_asof(df_vcl, df_flx,
-                           left_on="Vicell date/time",
-                           right_on="Flex date/time",
-                           direction="nearest",
-                           by="Vicell Sample ID",
-                           tolerance=pd.Timedelta("30 minutes"))
+    # position of the paired flex row for every vicell row, -1 if nothing within tolerance
+    match = _nearest_positions(df_vcl["Vicell Sample ID"], df_vcl["Vicell date/time"],
+                               normalize_ids(df_flx["Flex Sample ID"]), df_flx["Flex date/time"],
+                               tolerance, direction)
 
-    # trmming down to only viCell columns from first merge, will use rank to do an outer merge with flex data
-    columns_to_keep = ['Vicell Sample ID', 'Vicell date/time', 'Viability(%)', 'Viable cells/ml (x10^6)', 'Rank']
-    merged = merged[columns_to_keep].copy()
-    df_flx.drop('Vicell Sample ID', axis=1, inplace=True)  # dropping scafflold column
-    merged = merged.merge(df_flx, on="Rank", how="outer").copy()
+    # flex rows no vicell row was paired with are appended after the vicell rows
+    unpaired = np.setdiff1d(np.arange(df_flx.shape[0]), match)
+    vcl_rows = np.concatenate([np.arange(df_vcl.shape[0]), np.full(len(unpaired), -1)])
+    flx_rows = np.concatenate([match, unpaired])
 
-    # filling in Sample ID and date/time
-    merged = merged.assign(Sample_ID=lambda x: x.filter(like="Sample ID").bfill(1).iloc[:, 0])
-    merged = merged.assign(datetime=lambda x: x.filter(like="date/time").bfill(1).iloc[:, 0])
+    # one gather per side, -1 is not in the index and becomes an empty (NaN) row
+    merged = pd.concat([df_vcl.reindex(vcl_rows).reset_index(drop=True),
+                        df_flx.reindex(flx_rows).reset_index(drop=True)], axis=1)
 
-    # shortening Sample_ID to 5 characters
-    merged["Sample_ID"] = merged["Sample_ID"].str.slice(0, 5)
+    # filling in Sample ID and date/time, vicell first then flex. Sample ID shortened to 5 characters
+    merged["Sample ID"] = normalize_ids(merged["Vicell Sample ID"].fillna(merged["Flex Sample ID"]))
+    merged["datetime"] = merged["Vicell date/time"].fillna(merged["Flex date/time"])
 
-    #Renaming Sample_ID back to Sample ID, (couldnt have spaces in assign)
-    merged.rename(columns={"Sample_ID":"Sample ID"}, inplace=True)
+    merged.sort_values(by="datetime", kind="mergesort", inplace=True)
+    merged.reset_index(drop=True, inplace=True)
 
     print("#### Merge Report ####")
     print("\n")
@@ -359,6 +778,162 @@ def merge_vcl_flx(df_vcl, df_flx):
 
     return merged
 
+def _insert_sorted(df_old, df_new, clm):
+    """
+    Inserts rows of df_new into df_old at their sorted position. Both dataframes must already be sorted by clm.
+    The existing rows are not re-sorted, the new rows are placed with a binary search.
+
+    Input: df_old, df_new, clm (name of the sort column)
+    Return: dataframe, index reset
+    """
+    if df_old.shape[0] == 0:
+        return df_new.reset_index(drop=True)
+    if df_new.shape[0] == 0:
+        return df_old.reset_index(drop=True)
+
+    n_old = df_old.shape[0]
+    n_new = df_new.shape[0]
+
+    # position of every new row in the combined table, existing rows fill the remaining positions
+    pos = df_old[clm].searchsorted(df_new[clm], side="right") + np.arange(n_new)
+    is_new = np.zeros(n_old + n_new, dtype=bool)
+    is_new[pos] = True
+
+    take = np.empty(n_old + n_new, dtype=np.int64)
+    take[is_new] = np.arange(n_old, n_old + n_new)
+    take[~is_new] = np.arange(n_old)
+
+    df = pd.concat([df_old, df_new], ignore_index=True)
+    return df.take(take).reset_index(drop=True)
+
+def _new_files(D_df, manifest):
+    """
+    Splits a dictionary of dataframes into files already merged (listed in manifest with the same size and mtime)
+    and new files. The manifest passed in is not changed.
+
+    Return: tuple (dictionary of new files, new manifest of every file in D_df, list of files in the manifest that
+            have been modified or removed since they were merged)
+    """
+    D_new = {}
+    new_manifest = {}
+    changed = [key for key in manifest if key not in D_df]  # removed or renamed
+    for key, df in D_df.items():
+        stat = os.stat(key) if os.path.exists(key) else None
+        record = [stat.st_size, stat.st_mtime_ns] if stat is not None else None
+        new_manifest[key] = record
+        if key not in manifest:
+            D_new[key] = df
+        elif manifest[key] != record:
+            changed.append(key)
+    return D_new, new_manifest, changed
+
+def merge_incremental(D_vcl, D_flx, state_dir=".bsr_merged", dict_change=None, rebuild=False, return_affected=False):
+    """
+    Incremental equivalent of vicell_merge_convert -> flex_merge -> rename_flex_sample_id -> merge_vcl_flx.
+
+    A manifest of already merged files is kept in state_dir next to the merged tables. Only rows from files that are
+    not in the manifest are merged: they are de-duplicated against the existing history and inserted at their sorted
+    position, and the ViCell - FLEX join is recomputed only for the reactors those rows belong to.
+
+    If a file that was already merged has been modified or removed, or rebuild=True, the merge is done from scratch.
+
+    Input: D_vcl - dictionary of cleaned ViCell dataframes (vicell_clean or vicell_import_cached)
+           D_flx - dictionary of checked FLEX dataframes (flex_check_format or flex_import_cached)
+           state_dir - directory holding the manifest and merged tables between runs
+           dict_change (optional) - dictionary of sample ID corrections, see rename_flex_sample_id
+           rebuild - bool, ignore the stored state and merge everything
+           return_affected - bool, also return the set of reactors (Sample ID) that were re-joined, None when the merge
+                             was done from scratch (every reactor, and reactors of removed files are gone)
+    Return: tuple of dataframes (df_vcl, df_flx, merged), as returned by vicell_merge_convert, flex_merge and
+            merge_vcl_flx. merged is sorted by datetime. (df_vcl, df_flx, merged, affected) with return_affected
+    """
+    print("\n")
+    print("#### Incremental Merge Report ####")
+    print("\n")
+
+    manifest_path = os.path.join(state_dir, "manifest.json")
+    tables = ["vicell", "flex", "merged"]
+
+    if not rebuild and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        df_vcl, df_flx, merged = [pd.read_pickle(os.path.join(state_dir, i + ".pkl")) for i in tables]
+    else:
+        manifest = {"vicell": {}, "flex": {}}
+        df_vcl = df_flx = merged = None
+
+    D_vcl_new, vcl_manifest, vcl_changed = _new_files(D_vcl, manifest["vicell"])
+    D_flx_new, flx_manifest, flx_changed = _new_files(D_flx, manifest["flex"])
+    manifest = {"vicell": vcl_manifest, "flex": flx_manifest}
+
+    if vcl_changed or flx_changed:
+        print("Previously merged files modified or removed, merging from scratch: " + str(vcl_changed + flx_changed))
+        return merge_incremental(D_vcl, D_flx, state_dir, dict_change, rebuild=True, return_affected=return_affected)
+
+    print("New ViCell files: " + str(list(D_vcl_new.keys())))
+    print("New FLEX files: " + str(list(D_flx_new.keys())))
+
+    if not D_vcl_new and not D_flx_new:
+        print("Nothing to merge")
+        return (df_vcl, df_flx, merged, set()) if return_affected else (df_vcl, df_flx, merged)
+
+    # merging new files on their own, then folding them into the history
+    affected = set()
+
+    if D_vcl_new:
+        df_new = vicell_merge_convert(D_vcl_new)
+        if df_vcl is not None:
+            df_new = df_new[~df_new["Vicell date/time"].isin(df_vcl["Vicell date/time"])]
+        df_vcl = df_new.reset_index(drop=True) if df_vcl is None else _insert_sorted(df_vcl, df_new, "Vicell date/time")
+        affected.update(df_new["Vicell Sample ID"].dropna())
+
+    if D_flx_new:
+        df_new = flex_merge(D_flx_new)
+        if dict_change is not None:
+            df_new = rename_flex_sample_id(dict_change, df_new)
+        if df_flx is not None:
+            df_new = df_new[~df_new["Flex date/time"].isin(df_flx["Flex date/time"])]
+        df_flx = df_new.reset_index(drop=True) if df_flx is None else _insert_sorted(df_flx, df_new, "Flex date/time")
+        affected.update(normalize_ids(df_new["Flex Sample ID"]).dropna())
+
+    print("\n")
+    print("Reactors to re-join: " + str(sorted(affected)))
+    scratch = merged is None  # nothing merged before, every reactor is joined
+
+    # re-joining only the affected reactors
+    # empty, typed stand-ins when one of the instruments has no files yet
+    if df_vcl is None:
+        df_vcl = pd.DataFrame({"Vicell Sample ID": pd.Series(dtype=object),
+                               "Vicell date/time": pd.Series(dtype="datetime64[ns]"),
+                               "Viability(%)": pd.Series(dtype=float),
+                               "Viable cells/ml (x10^6)": pd.Series(dtype=float)})
+    if df_flx is None:
+        df_flx = pd.DataFrame({"Flex Sample ID": pd.Series(dtype=object),
+                               "Flex date/time": pd.Series(dtype="datetime64[ns]")})
+        for i in flex_columns[2:]:
+            df_flx[i] = pd.Series(dtype=float)
+
+    sub_vcl = df_vcl[df_vcl["Vicell Sample ID"].isin(affected)].copy()
+    sub_flx = df_flx[normalize_ids(df_flx["Flex Sample ID"]).isin(affected)].copy()
+    joined = merge_vcl_flx(sub_vcl, sub_flx)
+
+    if merged is None:
+        merged = joined.reset_index(drop=True)
+    else:
+        merged = merged[~merged["Sample ID"].isin(affected)]
+        merged = _insert_sorted(merged, joined, "datetime")
+
+    os.makedirs(state_dir, exist_ok=True)
+    for name, df in zip(tables, [df_vcl, df_flx, merged]):
+        df.to_pickle(os.path.join(state_dir, name + ".pkl"))
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+
+    if return_affected:
+        return df_vcl, df_flx, merged, None if scratch else affected
+    return df_vcl, df_flx, merged
+
+@stage("runtime")
 def calc_runtime(df):
     """
     Calculating runtime that is grouped by sample ID. Creates a new column in a dataframe: Runtime.
@@ -371,16 +946,16 @@ def calc_runtime(df):
     df.sort_values(by="datetime", inplace=True)
 
     #### Adding Flex Runtime Column (limiting sample ID to first 5 characters: R####) ####
-    df["Runtime"] = 0  # empty column with zeros
-    for key, grp in df.groupby(["Sample ID"]):
-        time_delta = grp["datetime"].diff()  # time difference
-        time_delta = time_delta.dt.total_seconds() / (24 * 60 * 60)  # converting to float
-        added_time = time_delta.cumsum()  # added time
-        added_time.iloc[0] = 0  # setting the first value to zero instead of Nan
+    # single grouped pass: elapsed time since the first sample of each Sample ID. Same as the running total of the
+    # time differences, without accumulating rounding error
+    sample_id = df["Sample ID"]
+    start = df.groupby(sample_id, sort=False)["datetime"].transform("first")  # first timestamp per Sample ID
+    added_time = (df["datetime"] - start).dt.total_seconds() / (24 * 60 * 60)  # added time, converting to float
 
-        ind = added_time.index
+    # first value of every Sample ID is zero instead of Nan, rows without a Sample ID are left at zero
+    added_time[~sample_id.duplicated() | sample_id.isna()] = 0
 
-        df.loc[ind, "Runtime"] = added_time
+    df["Runtime"] = added_time
 
     df["Titer"] = np.nan
     ordered_clms = ['Vicell Sample ID', 'Flex Sample ID',
@@ -405,37 +980,108 @@ def calc_runtime(df):
 
     return df
 
-def calc_qp(df):
-    """
-    Calculates Cell Specific Productivity in units of pg/cell day and inserts result into a new column "Qp".
-    Must contain columns: ["Runtime", "VCD", "Titer"]
-
-    PARAMETERS
-
-    df: datframe input
-
-
-    RETURN
-
-    df: original dataframe is returned with additional column, "Qp".
-
 
+def _offline_runtime(df, ids, times):
     """
+    Offline assay times as Runtime (days): numeric times are taken as reactor days already, datetimes are converted
+    with the first timestamp of the reactor in the timeline (df, calc_runtime output)
 
-    df["Qp"] = np.nan  # adding column to house data
-
-    for key, grp in df.groupby(["Sample ID"]):
-        temp = grp[grp["VCD"].notnull()]
+    Return: numpy float array
+    """
+    times = pd.Series(times).reset_index(drop=True)
+    if not np.issubdtype(times.dtype, np.datetime64):
+        return pd.to_numeric(times, errors="coerce").to_numpy(dtype=float)
 
-        time_delta = temp["Runtime"].diff()  # getting time delta (x axis delta)
-        VCD_shift = temp["VCD"].shift()  # shifting y column to do Yn + Y(n-1) for every row
-        VCD_trapezoids = (temp["VCD"] + VCD_shift) * time_delta / 2  # area of each trapezoid
-        IVCD = VCD_trapezoids.cumsum() * (10 ** 6)  # integrated area in units cells/mL * days
-        titer_pg_ml = temp["Titer"] * (10 ** 9)  # converting titer to pg/ml
+    start = df.groupby("Sample ID")["datetime"].min()
+    start = pd.Series(ids).reset_index(drop=True).map(start)
+    return ((times - start).dt.total_seconds() / (24 * 60 * 60)).to_numpy(dtype=float)
 
-        qp = titer_pg_ml / IVCD  # the result
-        ind = qp.index  # getting the index
+@stage("join")
+def join_offline(df, sources, direction="nearest"):
+    """
+    Attaches offline assay results (titer, amino acids, ...) to the merged timeline (calc_runtime output). Every assay
+    row is placed on the timeline row of the same reactor nearest in Runtime, within the tolerance of its source.
+    The rows of all sources are matched in one sorted sweep, see _nearest_positions.
+
+    INPUT: df - dataframe, calc_runtime output (columns Sample ID, datetime, Runtime)
+           sources - dictionary, key = source name, value = dictionary:
+               "df" - dataframe of assay results (or "path" - .csv file of assay results)
+               "columns" - list of assay columns, or dictionary assay column -> timeline column (e.g. {"mg/L": "Titer"})
+               "key" - column of reactor IDs, shortened to 5 characters. Default "Sample"
+               "time" - column of reactor day (float) or sample date/time (datetime). Default "Reactor Day"
+               "tolerance" - maximum distance in days (float) or pd.Timedelta / str. Default 0.5 day
+           direction - "nearest" (default), "backward" (timeline row at or before the assay) or "forward"
+
+    Timeline columns that already exist empty (e.g. the Titer column) are filled where an assay row was placed, other
+    rows keep their value. A timeline column that already holds data (e.g. FLEX Gln) is never overwritten, the assay
+    column is written to "<source name> <column>" instead (e.g. "aa Gln"). Missing assay values are not written.
+    When 2 rows of a source land on the same timeline row, the closest one is kept.
+
+    Output: dataframe, df with the assay columns
+    """
+    print("#### Offline Assay Join Report ####")
+    print("\n")
 
-        df.loc[ind, "Qp"] = qp  # index based assignment to original df
+    df = df.reset_index(drop=True)
+    if not sources:
+        return df
+
+    L_ids, L_runtime, L_tolerance, L_source = [], [], [], []
+    for n, (name, source) in enumerate(sources.items()):
+        data = source["df"] if "df" in source else pd.read_csv(source["path"])
+        ids = normalize_ids(data[source.get("key", "Sample")].astype(object)).reset_index(drop=True)
+        runtime = _offline_runtime(df, ids, data[source.get("time", "Reactor Day")])
+
+        tolerance = source.get("tolerance", 0.5)
+        if not isinstance(tolerance, (int, float)):
+            tolerance = pd.Timedelta(tolerance) / pd.Timedelta(days=1)
+
+        L_ids.append(ids)
+        L_runtime.append(runtime)
+        L_tolerance.append(np.full(len(ids), float(tolerance)))
+        L_source.append((name, data.reset_index(drop=True), source["columns"]))
+
+    ids = pd.concat(L_ids, ignore_index=True)
+    runtime = np.concatenate(L_runtime)
+    tolerance = np.concatenate(L_tolerance)
+
+    # timeline row of every assay row, all sources at once. Per-source tolerance applied after
+    match = _nearest_positions(ids, runtime, df["Sample ID"], df["Runtime"].to_numpy(dtype=float), None, direction)
+    distance = np.full(len(match), np.inf)
+    distance[match >= 0] = np.abs(runtime[match >= 0] - df["Runtime"].to_numpy(dtype=float)[match[match >= 0]])
+    match[distance > tolerance] = -1
+
+    created = set()  # columns filled by this join, sources can fill them together
+    offset = 0
+    for name, data, columns in L_source:
+        start = offset
+        rows = np.arange(start, start + data.shape[0])
+        offset += data.shape[0]
+        ok = rows[match[rows] >= 0]
+
+        # farthest first, so the closest assay row is written last on a timeline row
+        ok = ok[np.argsort(-distance[ok], kind="stable")]
+        if not isinstance(columns, dict):
+            columns = {i: i for i in columns}
+        for clm, target in columns.items():
+            if target in df.columns and target not in created and df[target].notna().any():
+                print(target + " already holds data, " + name + " " + clm + " written to: " + name + " " + target)
+                target = name + " " + target
+                if target in df.columns and target not in created and df[target].notna().any():
+                    raise ValueError("offline column " + target + " already holds data")
+            if target not in df.columns:
+                df[target] = np.nan
+            created.add(target)
+
+            values = pd.to_numeric(data[clm], errors="coerce").to_numpy(dtype=float)[ok - start]
+            present = ~np.isnan(values)  # a missing assay value leaves the timeline value as it is
+            filled = df[target].to_numpy(dtype=float, copy=True)
+            filled[match[ok][present]] = values[present]
+            df[target] = filled
+
+        print(name + ": " + str(len(ok)) + " of " + str(len(rows)) + " assay rows placed on the timeline")
+        unplaced = ids[rows[match[rows] < 0]]
+        if len(unplaced):
+            print("Not placed (no timeline row within tolerance), reactors: " + str(sorted(unplaced.dropna().unique())))
 
     return df
@@ -0,0 +1,171 @@
+"""
+Batch pipeline: ViCell and FLEX exports -> merged table with Runtime and Qp -> report figures, without a notebook.
+
+    convert + check + clean -> merge      (ViCell)  \\
+                                                      join -> runtime -> offline assays -> qp -> merged.csv, figures
+    convert -> check -> merge -> rename   (FLEX)    /
+
+The ViCell and FLEX branches are independent and run at the same time in two processes.
+
+usage (from bioreactor_results, or with bioreactor_results on PYTHONPATH):
+    python BSRpipeline.py --vicell /data/vicell --flex /data/flex --out /results/run_01
+    python BSRpipeline.py --vicell V --flex F --out O --workers 8 --xmax 14 --reactors R0019,R0020
+    python BSRpipeline.py --vicell V --flex F --out O --rename rename.json --store runs.db --no-figures
+    python BSRpipeline.py --vicell V --flex F --out O --offline offline.json
+
+offline.json lists the offline assay tables joined onto the timeline (join_offline), e.g. titer:
+    {"titer": {"path": "titer.csv", "key": "Sample", "time": "Reactor Day", "columns": {"mg/L": "Titer"},
+               "tolerance": 0.5}}
+
+outputs in --out:
+    merged.csv    - merged table (calc_runtime and calc_qp output)
+    figures/      - standard report figures (list_3pane and list_4pane of BSRplots)
+    stages.json   - stage timings and row counts (BSRinstrument)
+    pipeline.log  - the import, format and merge reports
+"""
+import os
+import io
+import sys
+import json
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use("Agg")  # headless, figures are only written to file
+
+from BSRmerge import (vicell_convert_clean, vicell_merge_convert, flex_convert_csv, flex_check_format, flex_merge,
+                      rename_flex_sample_id, merge_vcl_flx, calc_runtime, join_offline)
+from BSRkinetics import calc_qp
+from BSRplots import render_batch, report_jobs
+from BSRstore import store_write
+from BSRinstrument import stage_records, add_records, reset_records, export_json, stage_report
+
+
+def vicell_branch(directory, workers=None):
+    """
+    ViCell exports in directory -> vicell_merge_convert output, files failing the format check are left out.
+    Runs in its own process, the printed reports and stage records are returned to the caller.
+
+    Return: tuple (dataframe, report text, stage records)
+    """
+    reset_records()  # only the records of this branch go back, the process may have run another one before
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        D_df = vicell_convert_clean(workers, directory)
+        if not D_df:
+            raise FileNotFoundError("no ViCell .xlsx file could be converted in " + str(directory))
+        df = vicell_merge_convert(D_df)
+    return df, log.getvalue(), list(stage_records)
+
+def flex_branch(directory, workers=None, dict_change=None):
+    """
+    FLEX exports in directory -> flex_merge output, with mislabeled sample IDs renamed (dict_change, see
+    rename_flex_sample_id). Runs in its own process, the printed reports and stage records are returned to the caller.
+
+    Return: tuple (dataframe, report text, stage records)
+    """
+    reset_records()  # only the records of this branch go back, the process may have run another one before
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        D_df = flex_convert_csv(workers, directory=directory)
+        if not D_df:
+            raise FileNotFoundError("no FLEX .csv file could be converted in " + str(directory))
+        df = flex_merge(flex_check_format(D_df))
+        if dict_change:
+            df = rename_flex_sample_id(dict_change, df)
+    return df, log.getvalue(), list(stage_records)
+
+def run_pipeline(vicell_dir, flex_dir, out_dir, workers=None, dict_change=None, figures=True, biorx_list=None,
+                 xmax=None, store=None, offline=None):
+    """
+    Runs the whole pipeline and writes its outputs to out_dir (created if missing).
+
+    Input: vicell_dir, flex_dir - directories of the exports
+           out_dir - output directory
+           workers - int, processes used to parse files and render figures in each branch. Default serial
+           dict_change - dictionary of FLEX sample IDs to rename, see rename_flex_sample_id
+           figures - bool, render the standard report figures
+           biorx_list - list of reactor IDs in the figures. Default every reactor
+           xmax - int or float, x axis maximum of the figures (days)
+           store - path of a run store (BSRstore) the merged table is also written to
+           offline - dictionary of offline assay sources (titer, amino acids) joined before calc_qp, see join_offline
+    Return: tuple (merged dataframe, dictionary of figure render results)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    log_path = os.path.join(out_dir, "pipeline.log")
+
+    with open(log_path, "w") as log:
+        # independent branches, one process each
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            vicell = pool.submit(vicell_branch, vicell_dir, workers)
+            flex = pool.submit(flex_branch, flex_dir, workers, dict_change)
+            df_vcl, vicell_log, vicell_records = vicell.result()
+            df_flx, flex_log, flex_records = flex.result()
+        log.write(vicell_log + flex_log)
+        add_records(vicell_records + flex_records)
+
+        with contextlib.redirect_stdout(log):
+            merged = calc_runtime(merge_vcl_flx(df_vcl, df_flx))
+            if offline:
+                merged = join_offline(merged, offline)
+            merged = calc_qp(merged)
+            merged.to_csv(os.path.join(out_dir, "merged.csv"), index=False)
+            if store is not None:
+                store_write(store, merged)
+
+            D_results = {}
+            if figures:
+                if biorx_list is None:
+                    biorx_list = sorted(merged["Sample ID"].dropna().unique())
+                kwargs = {"outdir": os.path.join(out_dir, "figures")}
+                if xmax is not None:
+                    kwargs["xmax"] = xmax
+                D_results = render_batch(report_jobs(biorx_list, **kwargs), merged, workers)
+
+            stage_report()
+
+    export_json(os.path.join(out_dir, "stages.json"))
+
+    return merged, D_results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vicell", required=True, help="directory of the ViCell .xlsx exports")
+    parser.add_argument("--flex", required=True, help="directory of the FLEX .csv exports")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--workers", type=int, default=None, help="processes for file parsing and rendering")
+    parser.add_argument("--rename", default=None, help="JSON file of FLEX sample IDs to rename: "
+                                                       '{"R0012": ["R00120", "R012"]}')
+    parser.add_argument("--reactors", default=None, help="comma separated reactor IDs in the figures")
+    parser.add_argument("--xmax", type=float, default=None, help="x axis maximum of the figures (days)")
+    parser.add_argument("--no-figures", action="store_true", help="only write the merged table")
+    parser.add_argument("--store", default=None, help="also write the merged table to this run store (sqlite)")
+    parser.add_argument("--offline", default=None, help="JSON file of offline assay tables to join (titer, amino acids)")
+    args = parser.parse_args(argv)
+
+    dict_change = None
+    if args.rename is not None:
+        with open(args.rename) as f:
+            dict_change = json.load(f)
+
+    offline = None
+    if args.offline is not None:
+        with open(args.offline) as f:
+            offline = json.load(f)
+
+    merged, D_results = run_pipeline(args.vicell, args.flex, args.out, args.workers, dict_change,
+                                     not args.no_figures, args.reactors.split(",") if args.reactors else None,
+                                     args.xmax, args.store, offline)
+
+    failed = [key for key, value in D_results.items() if value is not None]
+    print("Merged rows: " + str(merged.shape[0]) + ", reactors: " + str(merged["Sample ID"].nunique()))
+    print("Figures: " + str(len(D_results) - len(failed)) + " rendered, " + str(len(failed)) + " failed")
+    print("Outputs: " + os.path.abspath(args.out))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,24 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+import matplotlib
 import math
+import os
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 
 
 import matplotlib.cm #color maps for plots
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+
+from BSRkinetics import calc_qp, calc_kinetics
+from BSRindex import build_reactor_index, select_reactors, split_reactors
+from BSRschema import analytes
+from BSRstore import store_query
+from BSRinstrument import stage, stage_records, add_records, reset_records
+from BSRcache import cache_evict
 
 
 def global_color():
@@ -88,18 +102,155 @@ def manipulating_kwargs(**kwargs):
     return kwargs_dict
 
 
-ylabels = {'VCD': "10E6 Cells/mL", 'Viability': "% Viable", 'Titer': "g/L", 'O2 Saturation': "% Air Saturation",
-               'PCO2': "mmHg", 'Gluc': "g/L", 'Lac': "g/L", 'pH': "pH", 'NH4+': "mmol/L", 'Gln': "mmol/L",
-               'Glu': "mmol/L", 'Na+': "mmol/L", 'K+': "mmol/L", 'Ca++': "mmol/L", "Qp": "pg/cell day",
-               "Osm": "mOsm/kg"}
+# axis labels (units) and y axis minimum per column, from the analyte registry
+ylabels = {i: analytes[i]["unit"] for i in analytes}
 
     # y axis minimum
-dict_ymin = {'VCD': 0, 'Viability': 40, 'Titer': 0, 'O2 Saturation': 0, 'PCO2': 0, "Osm": 250,
-            'Gluc': 0, 'Lac': 0, 'pH': 6.4, 'NH4+': 0, 'Gln': 0, 'Glu': 0, 'Na+': 0, 'K+': 0, 'Ca++': 0, "Qp": 0}
+dict_ymin = {i: analytes[i]["ymin"] for i in analytes}  # None: rates go negative
+
+
+
+
+# bump when the drawing code changes, so figures cached by older code are not reused
+_figure_version = 1
+
+# content addressed store of rendered figures, in the directory figures are saved to
+figure_cache_dir = ".figure_cache"
+
+# size limit of each figure cache, least recently used figures are evicted past it
+figure_cache_max_bytes = 512 * 1024 ** 2
+
+def _figure_key(df, clms, kwargs_dict, params):
+    """
+    Hash of everything that goes into a figure: the filtered data subset, the columns, the resolved color/legend
+    mapping from manipulating_kwargs and the figure parameters (plot function, axis limits, every other kwarg that
+    changes the saved file). Only computed when the cache kwarg is set, hashing the data costs a pass over it.
+
+    return: str, hex digest
+    """
+    h = hashlib.sha1()
+    h.update(pd.util.hash_pandas_object(df[["Sample ID", "Runtime"] + clms], index=False).values.tobytes())
+    h.update(repr((_figure_version, clms, sorted(kwargs_dict.items()), params)).encode())
+    return h.hexdigest()
 
+def _figure_path(fig_name, outdir=None):
+    """
+    Path a figure is saved to: fig_name in outdir (created if missing), or in the present working directory
+    """
+    if outdir is None:
+        return fig_name
+    os.makedirs(outdir, exist_ok=True)
+    return os.path.join(outdir, fig_name)
+
+def _grid_name(clms_list):
+    """
+    Default file name of a plot_grid figure: first and last column, and the number of panels
+    """
+    return (str(clms_list[0]) + " - " + str(clms_list[-1]) + " (" + str(len(clms_list)) + " panels).png"
+            ).replace("/", "_")
 
+def _figure_cache_hit(key, fig_name):
+    """
+    Copies a previously rendered figure with the same key to fig_name.
 
+    return: True if the figure was found in the cache
+    """
+    cached = os.path.join(os.path.dirname(fig_name), figure_cache_dir, key + ".png")
+    if not os.path.exists(cached):
+        return False
+    shutil.copyfile(cached, fig_name)
+    os.utime(cached)  # marking as recently used for eviction
+    print(fig_name + ": unchanged, reused from cache")
+    return True
+
+def _figure_cache_store(key, fig_name):
+    """
+    Adds a freshly rendered figure to the cache, evicting the least recently used figures past figure_cache_max_bytes
+    """
+    cache_dir = os.path.join(os.path.dirname(fig_name), figure_cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    shutil.copyfile(fig_name, os.path.join(cache_dir, key + ".png"))
+    cache_evict(cache_dir, figure_cache_max_bytes, (".png",))
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-triangle-three-buckets style downsampling: keeps the points that preserve the visual shape of a line.
+
+    The first and last points are always kept, the points in between are split into n_out - 2 equal buckets and the
+    point forming the largest triangle with its neighbouring buckets is kept from each bucket. Classic LTTB anchors
+    each triangle on the point picked in the previous bucket, which has to be done one bucket at a time. Here both
+    neighbours are the bucket averages, so all buckets are computed at once with numpy.
+
+    x, y:
+        numpy arrays of finite values, x sorted ascending
+
+    n_out:
+        int, number of points to keep
+
+    return: numpy array of the positions of the kept points, ascending
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    n_buckets = n_out - 2
+    edges = np.linspace(1, n - 1, n_buckets + 1).astype(int)  # bucket b holds points edges[b] to edges[b+1] - 1
+    inner = np.arange(1, n - 1)
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+
+    # average point of every bucket, with the first and last points as the outer neighbours
+    counts = np.bincount(bucket, minlength=n_buckets)
+    avg_x = np.concatenate([[x[0]], np.bincount(bucket, weights=x[inner], minlength=n_buckets) / counts, [x[-1]]])
+    avg_y = np.concatenate([[y[0]], np.bincount(bucket, weights=y[inner], minlength=n_buckets) / counts, [y[-1]]])
+
+    # triangle (previous bucket average, point, next bucket average), twice the area
+    ax, ay = avg_x[bucket], avg_y[bucket]
+    cx, cy = avg_x[bucket + 2], avg_y[bucket + 2]
+    area = np.abs((ax - cx) * (y[inner] - ay) - (ax - x[inner]) * (cy - ay))
+
+    # largest triangle in each bucket, buckets are contiguous so a reduceat gives every bucket maximum at once
+    largest = np.maximum.reduceat(area, edges[:-1] - 1)
+    candidates = np.flatnonzero(area == largest[bucket])
+    first = np.ones(len(candidates), dtype=bool)  # first point on ties
+    first[1:] = bucket[candidates][1:] != bucket[candidates][:-1]
+
+    return np.concatenate([[0], inner[candidates[first]], [n - 1]])
+
+def _plot_points(grp, clm, max_points=None):
+    """
+    Points drawn for one reactor and one column: (scatter x, scatter y, line x, line y).
+    The line skips missing values so it doesn't break. With max_points, both are downsampled with lttb to at most
+    max_points points.
+    """
+    mask = np.isfinite(grp[clm])  # masking off missing data to avoid breaks in line plots
+
+    if max_points is None:
+        return grp['Runtime'], grp[clm], grp['Runtime'][mask], grp[clm][mask]
+
+    x = grp['Runtime'][mask].to_numpy(dtype=float)
+    y = grp[clm][mask].to_numpy(dtype=float)
+    order = np.argsort(x, kind="stable")
+    x, y = x[order], y[order]
+
+    keep = lttb(x, y, max_points)
+    return x[keep], y[keep], x[keep], y[keep]
+
+def _from_store(df, biorx_list, clms, x):
+    """
+    Plot input: a dataframe is used as it is, a str is the path of a run store (BSRstore) that is queried for the
+    reactors in biorx_list, the columns plotted and the Runtime window up to xmax only.
+    """
+    if not isinstance(df, str):
+        return df
+
+    if (type(x) == int) or (type(x) == float):
+        runtime = (None, x + 0.5)
+    else:
+        runtime = None
+    return store_query(df, biorx_list, ["Runtime"] + list(clms), runtime)
 
+@stage("plot", data_arg=2)
 def plot_3by1(biorx_list, clms_list, df, **kwargs):
     """
 ###INPUTS###
@@ -116,6 +267,7 @@ clms_list:
 
 df:
     dataframe must contain columns: "Sample ID", "Runtime", at least 3 from clms_list
+    or str, path of a run store (BSRstore). Only the reactors, columns and runtime window plotted are read
 
 **kwargs:
 
@@ -131,6 +283,18 @@ color = dict of {"Sample ID": "color str"}
 
     example: {"R0010":"red5", "R0025":"blue5"}
 
+cache = bool
+    reuse the saved figure when data, columns, colors/legend and axis limits are unchanged (default False)
+
+max_points = int
+    downsample each reactor and column to at most this many points before drawing (see lttb). Default draws all
+
+index = dict
+    reactor index of df (BSRindex.build_reactor_index(df["Sample ID"])). Selects reactors without scanning df
+
+outdir = str
+    directory the figure is saved to (created if missing). Default present working directory
+
     """
 
     #### plot specifications ###
@@ -141,8 +305,11 @@ color = dict of {"Sample ID": "color str"}
     # lgnd = kwargs.get("legend", None) #This needs to be updated to incorporate legend options
     x = kwargs.get("xmax", None)
 
-    # filter data from input list
-    df = df[df["Sample ID"].isin(biorx_list)]
+    # run store (BSRstore): reading only the selected reactors, columns and runtime window
+    df = _from_store(df, biorx_list, clms_list, x)
+
+    # filter data from input list, rows come back grouped by reactor
+    df = select_reactors(df, biorx_list, kwargs.get("index", None))
 
     # filter data Runtime by xmax parameter if kwarg exists
     if (type(x) == int) or (type(x) == float):
@@ -158,6 +325,18 @@ color = dict of {"Sample ID": "color str"}
     else:
         xmax = 14.5
 
+    max_points = kwargs.get("max_points", None)
+
+    # reusing the saved figure if nothing that goes into it has changed
+    fig_name = _figure_path(str(clms_list) + ".png", kwargs.get("outdir", None))
+    fig_key = None
+    if kwargs.get("cache", False):
+        fig_key = _figure_key(df, list(clms_list), kwargs_dict, ("plot_3by1", xmin, xmax, max_points))
+        if _figure_cache_hit(fig_key, fig_name):
+            return
+
+    groups = split_reactors(df)  # one dataframe per reactor, in sorted ID order
+
     #### FIGURE ####
 
     fig = plt.figure(figsize=(14, 10))
@@ -169,11 +348,10 @@ color = dict of {"Sample ID": "color str"}
         num += 1
 
         # iterating over grouped reactor ID
-        for key, grp in df.groupby(['Sample ID']):
-            ax.scatter(grp['Runtime'], grp[i], label='_nolegend_', color=kwargs_dict[key][0])  # Point plots
-
-            mask = np.isfinite(grp[i])  # masking off missing data to avoid breaks in line plots
-            ax.plot(grp['Runtime'][mask], grp[i][mask], label=kwargs_dict[key][1], color=kwargs_dict[key][0])
+        for key, grp in groups:
+            sx, sy, lx, ly = _plot_points(grp, i, max_points)  # line skips missing data, optional downsampling
+            ax.scatter(sx, sy, label='_nolegend_', color=kwargs_dict[key][0])  # Point plots
+            ax.plot(lx, ly, label=kwargs_dict[key][1], color=kwargs_dict[key][0])
 
         ax.xaxis.set_ticks(np.arange(0, 30, 2))  # forcing ticks, every even value
         ax.set_xlim(left=xmin, right=xmax)  # forcing a zero lower x limit (titer)
@@ -200,7 +378,9 @@ color = dict of {"Sample ID": "color str"}
     fig.tight_layout()
     fig.subplots_adjust(right=0.7)
 
-    plt.savefig((str(clms_list) + ".png"), dpi=500)
+    plt.savefig(fig_name, dpi=500)
+    if kwargs.get("cache", False):
+        _figure_cache_store(fig_key, fig_name)
 
 
 #def plot_3by1(biorx_list, clms_list, df, **kwargs):
@@ -307,6 +487,7 @@ xmax = int or float
     plt.savefig((str(clms_list) + ".png"), dpi=500)
 """
 
+@stage("plot", data_arg=2)
 def plot_2by2(biorx_list, clms_list, df, **kwargs):
     """
     ###INPUTS###
@@ -323,6 +504,7 @@ def plot_2by2(biorx_list, clms_list, df, **kwargs):
 
     df:
         dataframe must contain columns: "Sample ID", "Runtime", at least 3 from clms_list
+        or str, path of a run store (BSRstore). Only the reactors, columns and runtime window plotted are read
 
     **kwargs:
 
@@ -338,6 +520,18 @@ def plot_2by2(biorx_list, clms_list, df, **kwargs):
     xmax = int or float
         maximum value of the x-axis (days)
 
+    cache = bool
+        reuse the saved figure when data, columns, colors/legend and axis limits are unchanged (default False)
+
+    max_points = int
+        downsample each reactor and column to at most this many points before drawing (see lttb). Default draws all
+
+    index = dict
+        reactor index of df (BSRindex.build_reactor_index(df["Sample ID"])). Selects reactors without scanning df
+
+    outdir = str
+        directory the figure is saved to (created if missing). Default present working directory
+
     """
 
     #### plot specifications ###
@@ -347,8 +541,11 @@ def plot_2by2(biorx_list, clms_list, df, **kwargs):
 
     x = kwargs.get("xmax", None)
 
-    # filter data from input list
-    df = df[df["Sample ID"].isin(biorx_list)]
+    # run store (BSRstore): reading only the selected reactors, columns and runtime window
+    df = _from_store(df, biorx_list, clms_list, x)
+
+    # filter data from input list, rows come back grouped by reactor
+    df = select_reactors(df, biorx_list, kwargs.get("index", None))
 
     # filter data Runtime by xmax parameter if kwarg exists
     if (type(x) == int) or (type(x) == float):
@@ -364,19 +561,30 @@ def plot_2by2(biorx_list, clms_list, df, **kwargs):
     else:
         xmax = 14.5
 
+    max_points = kwargs.get("max_points", None)
+
+    # reusing the saved figure if nothing that goes into it has changed
+    fig_name = _figure_path(str(clms_list) + ".png", kwargs.get("outdir", None))
+    fig_key = None
+    if kwargs.get("cache", False):
+        fig_key = _figure_key(df, list(clms_list), kwargs_dict, ("plot_2by2", xmin, xmax, max_points))
+        if _figure_cache_hit(fig_key, fig_name):
+            return
+
+    groups = split_reactors(df)  # one dataframe per reactor, in sorted ID order
+
     #### FIGURE ####
 
     fig, axes = plt.subplots(nrows=2, ncols=2, figsize=(21, 10))
 
     for i, ax in enumerate(fig.axes):
 
-        for key, grp in df.groupby(['Sample ID']):
+        for key, grp in groups:
             clm = clms_list[i]  # column name from list, called by enumerated for loop
 
-            ax.scatter(grp['Runtime'], grp[clm], label='_nolegend_', color=kwargs_dict[key][0])  # Point plots
-
-            mask = np.isfinite(grp[clm])  # masking over NaN data (lines dont connect)
-            ax.plot(grp['Runtime'][mask], grp[clm][mask], label=kwargs_dict[key][1], color=kwargs_dict[key][0])
+            sx, sy, lx, ly = _plot_points(grp, clm, max_points)  # line skips NaN data, optional downsampling
+            ax.scatter(sx, sy, label='_nolegend_', color=kwargs_dict[key][0])  # Point plots
+            ax.plot(lx, ly, label=kwargs_dict[key][1], color=kwargs_dict[key][0])
 
         ax.xaxis.set_ticks(np.arange(0, 30, 2))
         ax.set_xlim(left=xmin, right=xmax)  # forcing a zero lower x limit (titer)
@@ -401,7 +609,9 @@ def plot_2by2(biorx_list, clms_list, df, **kwargs):
     fig.tight_layout()
     fig.subplots_adjust(right=0.79, wspace=0.15)
 
-    plt.savefig((str(clms_list) + ".png"), dpi=500)
+    plt.savefig(fig_name, dpi=500)
+    if kwargs.get("cache", False):
+        _figure_cache_store(fig_key, fig_name)
 
 #def plot_2by2(biorx_list, clms_list, df, **kwargs):
     """
@@ -497,6 +707,7 @@ def plot_2by2(biorx_list, clms_list, df, **kwargs):
     plt.savefig((str(clms_list) + ".png"), dpi=500)
     """
 
+@stage("plot", data_arg=2)
 def plot_single(biorx_list, clm, df, **kwargs):
     """
     ###INPUTS###
@@ -513,6 +724,7 @@ def plot_single(biorx_list, clm, df, **kwargs):
 
     df:
         dataframe must contain columns: "Sample ID", "Runtime", at least 3 from clms_list
+        or str, path of a run store (BSRstore). Only the reactors, columns and runtime window plotted are read
 
     **kwargs:
 
@@ -522,6 +734,18 @@ def plot_single(biorx_list, clm, df, **kwargs):
     xmax = int or float
         maximum value of the x-axis (days)
 
+    cache = bool
+        reuse the saved figure when data, columns, colors/legend and axis limits are unchanged (default False)
+
+    max_points = int
+        downsample each reactor and column to at most this many points before drawing (see lttb). Default draws all
+
+    index = dict
+        reactor index of df (BSRindex.build_reactor_index(df["Sample ID"])). Selects reactors without scanning df
+
+    outdir = str
+        directory the figure is saved to (created if missing). Default present working directory
+
     """
 
     #### plot specifications ###
@@ -531,8 +755,11 @@ def plot_single(biorx_list, clm, df, **kwargs):
 
     x = kwargs.get("xmax", None)
 
-    # filter data from input list
-    df = df[df["Sample ID"].isin(biorx_list)]
+    # run store (BSRstore): reading only the selected reactors, columns and runtime window
+    df = _from_store(df, biorx_list, [clm], x)
+
+    # filter data from input list, rows come back grouped by reactor
+    df = select_reactors(df, biorx_list, kwargs.get("index", None))
 
     # filter data Runtime by xmax parameter if kwarg exists
     if (type(x) == int) or (type(x) == float):
@@ -548,18 +775,30 @@ def plot_single(biorx_list, clm, df, **kwargs):
     else:
         xmax = 14.5
 
+    max_points = kwargs.get("max_points", None)
+
+    # reusing the saved figure if nothing that goes into it has changed
+    fig_name = _figure_path(str(clm) + ".png", kwargs.get("outdir", None))
+    fig_key = None
+    if kwargs.get("cache", False):
+        fig_key = _figure_key(df, [clm], kwargs_dict, ("plot_single", xmin, xmax, max_points))
+        if _figure_cache_hit(fig_key, fig_name):
+            return
+
+    groups = split_reactors(df)  # one dataframe per reactor, in sorted ID order
+
     #### FIGURE ####
 
     fig, ax = plt.subplots(figsize=(15, 7.5))
 
-    for key, grp in df.groupby(['Sample ID']):
+    for key, grp in groups:
         # clm = clms_list[i]  # column name from list, called by enumerated for loop
 
-        ax.scatter(grp['Runtime'], grp[clm], label='_nolegend_', color=kwargs_dict[key][0])  # Point plots
-        mask = np.isfinite(grp[clm])  # masking over NaN data (lines dont connect)
+        sx, sy, lx, ly = _plot_points(grp, clm, max_points)  # line skips NaN data, optional downsampling
+        ax.scatter(sx, sy, label='_nolegend_', color=kwargs_dict[key][0])  # Point plots
 
         # legend based on **kwarg legend dict presence
-        ax.plot(grp['Runtime'][mask], grp[clm][mask], label=kwargs_dict[key][1], color=kwargs_dict[key][0])
+        ax.plot(lx, ly, label=kwargs_dict[key][1], color=kwargs_dict[key][0])
 
     ax.xaxis.set_ticks(np.arange(0, 30, 2))
     ax.set_xlim(left=xmin, right=xmax)  # forcing a zero lower x limit (titer)
@@ -583,7 +822,9 @@ def plot_single(biorx_list, clm, df, **kwargs):
     fig.tight_layout()
     fig.subplots_adjust(right=0.70, wspace=0.15)
 
-    plt.savefig((str(clm) + ".png"), dpi=500, bbox_inches='tight')
+    plt.savefig(fig_name, dpi=500, bbox_inches='tight')
+    if kwargs.get("cache", False):
+        _figure_cache_store(fig_key, fig_name)
 
 
 
@@ -681,45 +922,290 @@ def plot_single(biorx_list, clm, df, **kwargs):
     plt.savefig((str(clm) + ".png"), dpi=500, bbox_inches='tight')
     """
 
-def calc_qp(df):
+
+@stage("plot", data_arg=2)
+def plot_grid(biorx_list, clms_list, df, **kwargs):
     """
-    Calculates Cell Specific Productivity in units of pg/cell day and inserts result into a new column "Qp".
-    Must contain columns: ["Runtime", "VCD", "Titer"]
+    Small multiples: one panel per column in a grid, for large analyte panels (amino acids, full FLEX panel).
+    All reactors of a panel are drawn as one LineCollection and one scatter, instead of a plot and a scatter call per
+    reactor, so the number of artists does not grow with the number of reactors.
+
+    ###INPUTS###
+    biorx_list:
+        list of bioreactor IDs to be plotted. Must match values in column "Sample ID"
+
+    clms_list:
+        list of columns to plot, 1 panel per column name. Columns without an entry in ylabels / dict_ymin get no
+        y label and an automatic y minimum
+
+    df:
+        dataframe must contain columns: "Sample ID", "Runtime" and every column in clms_list
+        or str, path of a run store (BSRstore). Only the reactors, columns and runtime window plotted are read
+
+    **kwargs:
+
+    legend, color, xmax, cache, max_points, index, outdir - see plot_2by2
+
+    ncols = int
+        panels per row. Default ceil(sqrt(number of columns))
+
+    fig_name = str
+        file name of the figure. Default "<first column> - <last column> (<n> panels).png"
+
+    dpi = int
+        resolution of the saved figure. Default 150
+    """
+
+    #### plot specifications ###
+
+    kwargs_dict = manipulating_kwargs(**locals())  # using seperate function to organize **kwargs
+
+    x = kwargs.get("xmax", None)
+
+    # run store (BSRstore): reading only the selected reactors, columns and runtime window
+    df = _from_store(df, biorx_list, clms_list, x)
+
+    # filter data from input list, rows come back grouped by reactor
+    df = select_reactors(df, biorx_list, kwargs.get("index", None))
+
+    if (type(x) == int) or (type(x) == float):
+        df = df[df["Runtime"] < x + 0.5]
+        xmax = x + 0.5
+    else:
+        xmax = 14.5
+    xmin = -0.5
+
+    max_points = kwargs.get("max_points", None)
+    ncols = kwargs.get("ncols", None) or math.ceil(math.sqrt(len(clms_list)))
+    nrows = math.ceil(len(clms_list) / ncols)
+
+    fig_name = _figure_path(kwargs.get("fig_name", None) or _grid_name(clms_list), kwargs.get("outdir", None))
+    fig_key = None
+    if kwargs.get("cache", False):
+        params = ("plot_grid", xmin, xmax, max_points, ncols, kwargs.get("dpi", 150))
+        fig_key = _figure_key(df, list(clms_list), kwargs_dict, params)
+        if _figure_cache_hit(fig_key, fig_name):
+            return
+
+    groups = split_reactors(df)  # one dataframe per reactor, in sorted ID order
+
+    # one color per reactor: the color kwarg, or the default color cycle in reactor order
+    cycle = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+    colors = [matplotlib.colors.to_rgba(kwargs_dict[key][0] if kwargs_dict[key][0] is not None else
+                                        cycle[n % len(cycle)]) for n, (key, grp) in enumerate(groups)]
+
+    #### FIGURE ####
+
+    fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=(3.6 * ncols, 2.8 * nrows), squeeze=False)
+
+    for i, ax in enumerate(axes.flat):
+        if i >= len(clms_list):
+            ax.set_visible(False)  # empty panels of the last row
+            continue
+        clm = clms_list[i]
+
+        segments, points, point_colors = [], [], []
+        for (key, grp), color in zip(groups, colors):
+            sx, sy, lx, ly = _plot_points(grp, clm, max_points)  # line skips NaN data, optional downsampling
+            segments.append(np.column_stack([np.asarray(lx, dtype=float), np.asarray(ly, dtype=float)]))
+            points.append(np.column_stack([np.asarray(sx, dtype=float), np.asarray(sy, dtype=float)]))
+            point_colors.append(np.tile(color, (len(points[-1]), 1)))
+
+        # all reactors in 2 artists
+        ax.add_collection(LineCollection(segments, colors=colors), autolim=True)
+        if points:
+            xy = np.concatenate(points)
+            ax.scatter(xy[:, 0], xy[:, 1], c=np.concatenate(point_colors), s=12, label='_nolegend_')
+        ax.autoscale_view()
+
+        ax.xaxis.set_ticks(np.arange(0, 30, 2))
+        ax.set_xlim(left=xmin, right=xmax)
+
+        ax.tick_params(axis='both', which='major', labelsize=8)  # tick labels size
+        ax.set_ylabel(ylabels.get(clm, ""), fontsize=8)  # y-axis label
+
+        ax.yaxis.grid(color='gray', linestyle='dashed')
+        ax.xaxis.grid(color='gray', linestyle='dashed')
+
+        ax.set_title(clm, fontsize=11)
+        ymin, ymax = ax.get_ylim()  # get the min and max of respective axes
+        ax.set_ylim(bottom=dict_ymin.get(clm, None), top=ymax * 1.05)
+
+        if i + ncols >= len(clms_list):  # bottom panel of its column
+            ax.set_xlabel("Time (Days)", fontsize=8, fontweight="bold")
+
+    # one legend entry per reactor, shared by all panels
+    handles = [Line2D([], [], color=color, marker="o", markersize=4) for color in colors]
+    labels = [kwargs_dict[key][1] for key, grp in groups]
+    shown = [(h, l) for h, l in zip(handles, labels) if l is not None]
+    width, height = fig.get_size_inches()
+    right = 1 - 0.15 / width
+    if shown:
+        legend_cols = math.ceil(len(shown) / (10 * nrows))
+        right = 1 - (0.2 + 1.4 * legend_cols) / width  # room for the legend, right of the panels
+        fig.legend([i[0] for i in shown], [i[1] for i in shown], loc="upper left", bbox_to_anchor=(right, 0.98),
+                   fontsize=8, frameon=False, ncol=legend_cols)
+
+    # fixed margins (inches) instead of tight_layout, which measures every tick label of every panel
+    fig.subplots_adjust(left=0.65 / width, right=right, bottom=0.5 / height, top=1 - 0.3 / height,
+                        wspace=0.4, hspace=0.45)
+
+    fig.savefig(fig_name, dpi=kwargs.get("dpi", 150))
+    if kwargs.get("cache", False):
+        _figure_cache_store(fig_key, fig_name)
+
+
+# dataframe shared by all jobs of a batch render, set once per worker process by _init_render_worker
+_shared_df = None
 
-    PARAMETERS
+_shared_index = None
 
-    df: datframe input
+_render_worker = False  # True in the worker processes of render_batch
 
+def _init_render_worker(df, index):
+    """
+    Worker process set up for render_batch: non-interactive backend, and the input dataframe and its reactor index
+    are stored once per process instead of being sent with every job.
+    """
+    global _shared_df, _shared_index, _render_worker
+    matplotlib.use("Agg")
+    _shared_df = df
+    _shared_index = index
+    _render_worker = True
 
-    RETURN
+def _render_job(job):
+    """
+    Renders one (biorx_list, clms_list, kwargs) job from the shared dataframe. The plot function is picked from
+    clms_list: a str is plot_single, 3 columns plot_3by1, 4 columns plot_2by2, more than 4 plot_grid.
 
-    df: original dataframe is returned with additional column, "Qp".
+    Return: tuple of (figure path, None or error message, stage records of the job)
+    """
+    biorx_list, clms_list = job[0], job[1]
+    kwargs = dict(job[2]) if len(job) > 2 else {}
+    kwargs.setdefault("index", _shared_index)
+    if _render_worker:
+        reset_records()  # a worker only keeps the records of its current job, they go back to render_batch
+    first = len(stage_records)
+
+    try:
+        if type(clms_list) == str:
+            plot_single(biorx_list, clms_list, _shared_df, **kwargs)
+        elif len(clms_list) == 3:
+            plot_3by1(biorx_list, clms_list, _shared_df, **kwargs)
+        elif len(clms_list) == 4:
+            plot_2by2(biorx_list, clms_list, _shared_df, **kwargs)
+        elif len(clms_list) > 4:
+            plot_grid(biorx_list, clms_list, _shared_df, **kwargs)
+        else:
+            raise ValueError("clms_list must be a column name, or a list of 3 or more columns")
+        error = None
+    except Exception as e:
+        error = repr(e)
+    finally:
+        plt.close("all")  # figures are saved to file, never kept around between jobs
 
+    return _job_path(clms_list, kwargs), error, stage_records[first:]
 
+def _job_path(clms_list, kwargs):
     """
+    Path the figure of a render_batch job is saved to, as the plot function picked by clms_list names it
+    """
+    if type(clms_list) != str and len(clms_list) > 4:
+        name = kwargs.get("fig_name", None) or _grid_name(clms_list)
+    else:
+        name = str(clms_list) + ".png"
+    outdir = kwargs.get("outdir", None)
+    return name if outdir is None else os.path.join(outdir, name)
 
-    df["Qp"] = np.nan  # adding column to house data
+def _separate_jobs(jobs):
+    """
+    Jobs saving to the same figure path (same columns, different reactors or kwargs) would overwrite each other's
+    file, at the same time in the pool. Each of them is moved to a sub directory of its own, named after its reactors
+    (or after its position in jobs when that is not enough).
 
-    for key, grp in df.groupby(["Sample ID"]):
-        temp = grp[grp["VCD"].notnull()]
+    Return: list of (biorx_list, clms_list, kwargs) jobs, every one saving to a different path
+    """
+    jobs = [(i[0], i[1], dict(i[2]) if len(i) > 2 else {}) for i in jobs]
+    paths = [_job_path(i[1], i[2]) for i in jobs]
+    counts = pd.Series(paths).value_counts()
+
+    taken = set(paths)
+    for n, (biorx_list, clms_list, kwargs) in enumerate(jobs):
+        if counts[paths[n]] == 1:
+            continue
+        label = "_".join(str(i) for i in biorx_list)
+        folder, name = os.path.split(paths[n])
+        if len(label) > 60 or os.path.join(folder, label, name) in taken:
+            label = "job" + str(n)
+        kwargs["outdir"] = os.path.join(folder, label)
+        if "fig_name" in kwargs:
+            kwargs["fig_name"] = name
+        taken.add(os.path.join(folder, label, name))
+
+    return jobs
+
+def render_batch(jobs, df, workers=None):
+    """
+    Renders many figures across a pool of worker processes on a non-interactive backend.
 
-        time_delta = temp["Runtime"].diff()  # getting time delta (x axis delta)
-        VCD_shift = temp["VCD"].shift()  # shifting y column to do Yn + Y(n-1) for every row
-        VCD_trapezoids = (temp["VCD"] + VCD_shift) * time_delta / 2  # area of each trapezoid
-        IVCD = VCD_trapezoids.cumsum() * (10 ** 6)  # integrated area in units cells/mL * days
-        titer_pg_ml = temp["Titer"] * (10 ** 9)  # converting titer to pg/ml
+    jobs:
+        list of tuples (biorx_list, clms_list, kwargs). kwargs is a dict of plot kwargs (legend, color, xmax) and
+        can be left out. clms_list picks the plot function: str = plot_single, 3 columns = plot_3by1,
+        4 columns = plot_2by2, more than 4 columns = plot_grid.
 
-        qp = titer_pg_ml / IVCD  # the result
-        ind = qp.index  # getting the index
+        example: [(list_BSR, fig1, {"legend": lgnd, "xmax": 14}), (list_BSR, "VCD")]
 
-        df.loc[ind, "Qp"] = qp  # index based assignment to original df
+    df:
+        dataframe, see plot functions. Sent to each worker process once, not once per job, together with a reactor
+        index built once for all jobs. A run store path (str) is sent as it is, every job queries its own reactors.
+
+    workers:
+        int, number of processes. None or 1 renders in the current process.
 
-    return df
+    Jobs that would save to the same file (same columns for different reactors) are each saved in a sub directory
+    named after their reactors, see _separate_jobs.
 
+    return: dictionary with key = figure path, value = None if rendered, error message if it failed
+    """
+    global _shared_df, _shared_index
 
+    print("#### Batch Render Report ####")
+    print("\n")
+    print("Figures to render: " + str(len(jobs)))
+    jobs = _separate_jobs(jobs)
 
+    # built once, every job selects its reactors from it. Jobs on a run store query their reactors instead
+    index = None if isinstance(df, str) else build_reactor_index(df["Sample ID"])
 
+    if workers is not None and workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker, initargs=(df, index)) as pool:
+            results = list(pool.map(_render_job, jobs))
+        # records made in the workers are returned with their jobs
+        add_records([record for name, error, records in results for record in records])
+    else:
+        _shared_df, _shared_index = df, index
+        try:
+            results = [_render_job(i) for i in jobs]
+        finally:
+            _shared_df, _shared_index = None, None
+
+    D_results = {}
+    for name, error, records in results:
+        D_results[name] = error
+        if error is None:
+            print(name + ": RENDERED")
+        else:
+            print(name + ": FAILED " + error)
 
+    return D_results
+
+def report_jobs(biorx_list, **kwargs):
+    """
+    Jobs for render_batch covering the standard report: every figure in list_3pane and list_4pane.
+
+    return: list of (biorx_list, clms_list, kwargs) tuples
+    """
+    return [(biorx_list, i, kwargs) for i in list_3pane + list_4pane]
 
 
 #Generic 3-pane and 4 pane plots to run plot functions in for loop
@@ -0,0 +1,120 @@
+import pandas as pd
+
+# analyte registry, one entry per column of the merged table (column names after calc_runtime)
+#   unit  - axis label used by the plots
+#   ymin  - y axis minimum used by the plots, None lets matplotlib scale the axis (rates go negative)
+#   dtype - storage dtype used by compact_dtypes. Instrument readings are reported with 2-4 significant digits,
+#           float32 (~7 significant digits, not an exact decimal) is precise enough for that printed resolution. Time
+#           and derived kinetics stay float64, they are differenced and integrated
+analytes = {
+    # ViCell
+    "VCD": {"unit": "10E6 Cells/mL", "ymin": 0, "dtype": "float32"},
+    "Viability": {"unit": "% Viable", "ymin": 40, "dtype": "float32"},
+    # offline
+    "Titer": {"unit": "g/L", "ymin": 0, "dtype": "float32"},
+    # FLEX
+    "Gln": {"unit": "mmol/L", "ymin": 0, "dtype": "float32"},
+    "Glu": {"unit": "mmol/L", "ymin": 0, "dtype": "float32"},
+    "Gluc": {"unit": "g/L", "ymin": 0, "dtype": "float32"},
+    "Lac": {"unit": "g/L", "ymin": 0, "dtype": "float32"},
+    "NH4+": {"unit": "mmol/L", "ymin": 0, "dtype": "float32"},
+    "Na+": {"unit": "mmol/L", "ymin": 0, "dtype": "float32"},
+    "K+": {"unit": "mmol/L", "ymin": 0, "dtype": "float32"},
+    "Ca++": {"unit": "mmol/L", "ymin": 0, "dtype": "float32"},
+    "pH": {"unit": "pH", "ymin": 6.4, "dtype": "float32"},
+    "PO2": {"unit": "mmHg", "ymin": 0, "dtype": "float32"},
+    "PCO2": {"unit": "mmHg", "ymin": 0, "dtype": "float32"},
+    "O2 Saturation": {"unit": "% Air Saturation", "ymin": 0, "dtype": "float32"},
+    "Osm": {"unit": "mOsm/kg", "ymin": 250, "dtype": "float32"},
+    "Vessel Temperature (°C)": {"unit": "°C", "ymin": None, "dtype": "float32"},
+    "Chemistry Dilution Ratio": {"unit": "Dilution Ratio", "ymin": 0, "dtype": "float32"},
+    "HCO3": {"unit": "mmol/L", "ymin": 0, "dtype": "float32"},
+    # time
+    "Runtime": {"unit": "Days", "ymin": 0, "dtype": "float64"},
+    # kinetics (BSRkinetics)
+    "Qp": {"unit": "pg/cell day", "ymin": 0, "dtype": "float64"},
+    "IVCD": {"unit": "10E6 Cells/mL day", "ymin": 0, "dtype": "float64"},
+    "mu": {"unit": "1/day", "ymin": None, "dtype": "float64"},
+    "q Gluc": {"unit": "pg/cell day", "ymin": None, "dtype": "float64"},
+    "q Lac": {"unit": "pg/cell day", "ymin": None, "dtype": "float64"},
+    "q Gln": {"unit": "pmol/cell day", "ymin": None, "dtype": "float64"},
+    "q NH4+": {"unit": "pmol/cell day", "ymin": None, "dtype": "float64"},
+}
+
+# ID columns, few distinct values repeated on every row: stored as categoricals
+id_columns = ["Sample ID", "Flex Sample ID"]
+
+# columns that can be rebuilt from the rest of the table, dropped by compact_dtypes
+#   Vicell Sample ID = Sample ID on rows with a ViCell sample (vicell_clean already shortens it to the reactor ID)
+redundant_columns = ["Vicell Sample ID"]
+
+
+def compact_dtypes(df, drop_redundant=True):
+    """
+    Converts the merged table (calc_runtime / calc_qp output) to compact storage: categorical ID columns, the
+    dtype from the analytes registry for every analyte, and redundant ID columns dropped.
+    Columns not in the registry are left as they are.
+
+    Input: df - merged dataframe, drop_redundant - bool, drops redundant_columns (default True). See expand_ids
+    Return: new dataframe
+    """
+    df = df.copy()
+
+    if drop_redundant:
+        df.drop(columns=[i for i in redundant_columns if i in df.columns], inplace=True)
+
+    for i in id_columns:
+        if i in df.columns:
+            df[i] = df[i].astype("category")
+
+    for i in df.columns:
+        if i in analytes:
+            df[i] = df[i].astype(analytes[i]["dtype"])
+
+    return df
+
+def expand_ids(df):
+    """
+    Adds back the ID columns compact_dtypes dropped, as object columns in their original position.
+
+    Input: df - compact dataframe, must contain columns: Sample ID, Vicell date/time
+    Return: new dataframe
+    """
+    df = df.copy()
+    if "Vicell Sample ID" not in df.columns:
+        vicell_id = df["Sample ID"].astype(object).where(df["Vicell date/time"].notna())
+        df.insert(0, "Vicell Sample ID", vicell_id)
+    return df
+
+def memory_usage(df):
+    """
+    Memory footprint of a dataframe in bytes, including the strings held by object columns
+    """
+    return int(df.memory_usage(deep=True).sum())
+
+def memory_report(df_before, df_after):
+    """
+    Prints the memory footprint of a dataframe before and after compact_dtypes, per column and in total.
+
+    Input: df_before, df_after
+    Return: dataframe, bytes per column before and after (columns dropped in df_after show 0)
+    """
+    before = df_before.memory_usage(deep=True, index=False)
+    after = df_after.memory_usage(deep=True, index=False).reindex(before.index, fill_value=0)
+    report = pd.DataFrame({"before": before, "after": after,
+                           "dtype before": df_before.dtypes.astype(str),
+                           "dtype after": df_after.dtypes.astype(str).reindex(before.index, fill_value="dropped")})
+
+    total_before = memory_usage(df_before)
+    total_after = memory_usage(df_after)
+
+    print("#### Memory Report ####")
+    print("\n")
+    print(report.to_string())
+    print("\n")
+    print("Rows: " + str(df_before.shape[0]))
+    print("Total before: %.2f MB" % (total_before / 1024 ** 2))
+    print("Total after: %.2f MB" % (total_after / 1024 ** 2))
+    print("Reduction: %.1f%%" % (100 * (1 - total_after / max(total_before, 1))))
+
+    return report
@@ -0,0 +1,170 @@
+import pandas as pd
+import numpy as np
+import sqlite3
+
+# local run store: one sqlite table holding the merged table (merge_vcl_flx / calc_runtime / calc_qp output) of
+# every run imported so far, indexed on (Sample ID, datetime) so a query only reads the rows of the reactors asked for.
+# Timestamps are stored as int nanoseconds in columns declared TIMESTAMP, and converted back on query.
+
+run_table = "runs"
+query_reactors = "query_reactors"  # temp table of the reactors asked for by store_query
+
+
+def _quote(name):
+    """
+    sqlite identifier, column names contain spaces, signs and brackets ("NH4+", "Vessel Temperature (°C)")
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _declared_type(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "TIMESTAMP"
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return "REAL"
+    return "TEXT"
+
+def _table_columns(con, table):
+    """
+    Return: dictionary, column name -> declared type. Empty if the table does not exist
+    """
+    return {row[1]: row[2] for row in con.execute("PRAGMA table_info(" + _quote(table) + ")")}
+
+def _to_sql_values(df):
+    """
+    Column values as python objects sqlite accepts: datetimes to int nanoseconds, missing values to None
+    """
+    columns = []
+    for i in df.columns:
+        s = df[i]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            values = s.to_numpy(dtype="datetime64[ns]").astype(np.int64).astype(object)
+            values[s.isna().to_numpy()] = None
+        elif _declared_type(s) == "REAL":
+            values = s.to_numpy(dtype=float).astype(object)
+            values[np.isnan(s.to_numpy(dtype=float))] = None
+        else:
+            values = s.astype(object).to_numpy()
+            values[pd.isna(values)] = None
+        columns.append(values)
+    return list(zip(*columns))
+
+def store_write(db, df, table=run_table):
+    """
+    Writes a merged dataframe to the run store. Reactors in df replace whatever the store held for them, every other
+    reactor is left as it is, so re-importing a run never duplicates rows. Columns new to the store (e.g. kinetics
+    added later) are added to the table.
+
+    Input: db - path of the sqlite file (created if missing), df - dataframe, must contain columns: Sample ID, datetime
+           Rows without a Sample ID are not written.
+           table - str, table name (default "runs")
+    Return: int, number of rows written
+    """
+    # rows without a reactor can't be replaced on re-import (NULL never matches), they are left out of the store
+    no_reactor = df["Sample ID"].isna()
+    df = df[~no_reactor].reset_index(drop=True)
+
+    con = sqlite3.connect(db)
+    try:
+        with con:  # one transaction, a failed write leaves the store as it was
+            existing = _table_columns(con, table)
+            if not existing:
+                con.execute("CREATE TABLE " + _quote(table) + " ("
+                            + ", ".join(_quote(i) + " " + _declared_type(df[i]) for i in df.columns) + ")")
+                con.execute("CREATE INDEX " + _quote(table + "_reactor_time") + " ON " + _quote(table)
+                            + " (" + _quote("Sample ID") + ", " + _quote("datetime") + ")")
+            else:
+                for i in df.columns:
+                    if i not in existing:
+                        con.execute("ALTER TABLE " + _quote(table) + " ADD COLUMN " + _quote(i) + " "
+                                    + _declared_type(df[i]))
+
+            reactors = [(i,) for i in df["Sample ID"].dropna().unique()]
+            con.executemany("DELETE FROM " + _quote(table) + " WHERE " + _quote("Sample ID") + " = ?", reactors)
+
+            con.executemany("INSERT INTO " + _quote(table) + " (" + ", ".join(_quote(i) for i in df.columns)
+                            + ") VALUES (" + ", ".join("?" * df.shape[1]) + ")", _to_sql_values(df))
+    finally:
+        con.close()
+
+    print("#### Store Report ####")
+    print("\n")
+    print("Reactors written: " + str([i[0] for i in reactors]))
+    print("Rows written: " + str(df.shape[0]))
+    if no_reactor.any():
+        print("Rows without Sample ID, not written: " + str(int(no_reactor.sum())))
+
+    return df.shape[0]
+
+def store_query(db, biorx_list=None, columns=None, runtime=None, table=run_table):
+    """
+    Reads rows from the run store. Only the requested reactors, columns and runtime window are read from disk.
+
+    Input: db - path of the sqlite file
+           biorx_list - list of reactor IDs (Sample ID). Default every reactor
+           columns - list of columns. "Sample ID" and "datetime" are always returned. Default every column
+           runtime - tuple (min, max) in days, min <= Runtime < max. Either can be None (open ended). Default no limit
+           table - str, table name (default "runs")
+    Return: dataframe sorted by datetime, as calc_runtime returns it
+    """
+    con = sqlite3.connect(db)
+    try:
+        declared = _table_columns(con, table)
+        if not declared:
+            raise ValueError("no table " + table + " in run store " + str(db))
+
+        if columns is None:
+            columns = list(declared)
+        else:
+            missing = [i for i in columns if i not in declared]
+            if missing:
+                raise KeyError("columns not in run store: " + str(missing))
+            columns = ["Sample ID", "datetime"] + [i for i in dict.fromkeys(columns) if i not in ("Sample ID", "datetime")]
+
+        where, params = [], []
+        if biorx_list is not None:
+            # reactor IDs go through a temp table, an IN (?, ...) list is capped by SQLITE_MAX_VARIABLE_NUMBER
+            con.execute("CREATE TEMP TABLE " + _quote(query_reactors) + " (id PRIMARY KEY)")
+            con.executemany("INSERT OR IGNORE INTO " + _quote(query_reactors) + " VALUES (?)",
+                            [(i,) for i in biorx_list])
+            where.append(_quote("Sample ID") + " IN (SELECT id FROM " + _quote(query_reactors) + ")")
+        if runtime is not None:
+            if runtime[0] is not None:
+                where.append(_quote("Runtime") + " >= ?")
+                params.append(float(runtime[0]))
+            if runtime[1] is not None:
+                where.append(_quote("Runtime") + " < ?")
+                params.append(float(runtime[1]))
+
+        sql = "SELECT " + ", ".join(_quote(i) for i in columns) + " FROM " + _quote(table)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY " + _quote("datetime") + ", rowid"
+
+        rows = con.execute(sql, params).fetchall()
+    finally:
+        con.close()
+
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    for i in columns:
+        if declared[i] == "TIMESTAMP":
+            values = df[i].to_numpy(dtype=object)
+            values[pd.isna(values)] = np.iinfo(np.int64).min  # NaT
+            df[i] = values.astype(np.int64).view("datetime64[ns]")
+        elif declared[i] == "REAL":
+            df[i] = df[i].astype("float64")
+        else:
+            df[i] = df[i].astype(object)
+
+    return df
+
+def store_reactors(db, table=run_table):
+    """
+    Return: list of reactor IDs in the run store, sorted
+    """
+    con = sqlite3.connect(db)
+    try:
+        rows = con.execute("SELECT DISTINCT " + _quote("Sample ID") + " FROM " + _quote(table)
+                           + " WHERE " + _quote("Sample ID") + " IS NOT NULL ORDER BY 1").fetchall()
+    finally:
+        con.close()
+    return [i[0] for i in rows]
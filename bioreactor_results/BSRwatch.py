@@ -0,0 +1,188 @@
+"""
+Watch mode: polls the ViCell and FLEX export directories, and when new or modified exports land, updates the merged
+table and figures for the reactors those files touch only.
+
+    new file -> cached import (only new files parsed) -> merge_incremental (re-join affected reactors)
+             -> calc_runtime / calc_qp on affected reactors -> re-render figures that include them
+
+usage (from bioreactor_results, or with bioreactor_results on PYTHONPATH):
+    python BSRwatch.py --vicell /data/vicell --flex /data/flex --out /results/live --interval 30
+
+outputs in --out:
+    merged.csv     - merged table with Runtime and Qp, rewritten after every update
+    figures/R####/ - standard report figures of every reactor (report_jobs), re-rendered when the reactor changes
+    state/         - parsed-file cache, incremental merge state and processed table, kept between restarts
+"""
+import os
+import sys
+import time
+import json
+import argparse
+
+import matplotlib
+matplotlib.use("Agg")  # headless, figures are only written to file
+
+import pandas as pd
+
+from BSRmerge import (vicell_import_cached, flex_import_cached, merge_incremental, calc_runtime, _insert_sorted,
+                      _list_files)
+from BSRkinetics import calc_qp
+from BSRindex import normalize_ids
+from BSRplots import render_batch, report_jobs
+from BSRinstrument import reset_records
+
+
+def snapshot(directories):
+    """
+    Size and modification time of every export in the watched directories
+
+    Input: directories - list of tuples (directory, extension)
+    Return: dictionary, key = file path, value = (size, mtime)
+    """
+    files = {}
+    for directory, extension in directories:
+        for i in _list_files(directory, extension):
+            stat = os.stat(i)
+            files[i] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+def file_reactors(D_df, L_files):
+    """
+    Reactors (Sample ID shortened to R####) each file touches
+
+    Return: dictionary, key = file, value = sorted list of reactor IDs
+    """
+    return {i: sorted(normalize_ids(D_df[i]["Sample ID"]).dropna().unique()) for i in L_files if i in D_df}
+
+def reactor_jobs(biorx_list, fig_dir, **kwargs):
+    """
+    Default figures: the standard report (report_jobs) of every reactor, in fig_dir/<reactor>
+
+    Return: list of (biorx_list, clms_list, kwargs) jobs for render_batch
+    """
+    jobs = []
+    for i in biorx_list:
+        jobs += report_jobs([i], outdir=os.path.join(fig_dir, i), **kwargs)
+    return jobs
+
+def update(vicell_dir, flex_dir, out_dir, changed=None, workers=None, dict_change=None, jobs=None, **kwargs):
+    """
+    One update: imports the exports (only new or modified files are parsed), merges them incrementally, recomputes
+    Runtime and Qp for the affected reactors and re-renders the figures that include them.
+
+    Input: vicell_dir, flex_dir - export directories
+           out_dir - output directory (see module docstring)
+           changed - list of files that changed since the last update, for the report. Default all files
+           workers - int, processes for parsing and rendering
+           dict_change - dictionary of FLEX sample IDs to rename, see rename_flex_sample_id
+           jobs - list of render_batch jobs. Re-rendered when their biorx_list includes an affected reactor.
+                  Default reactor_jobs for the affected reactors
+           **kwargs - plot kwargs of the default jobs (legend, color, xmax)
+    Return: tuple (processed dataframe, set of affected reactors, dictionary of figure render results)
+    """
+    state_dir = os.path.join(out_dir, "state")
+    cache_dir = os.path.join(state_dir, "cache")
+    processed_path = os.path.join(state_dir, "processed.pkl")
+
+    D_vcl = vicell_import_cached(cache_dir, workers, directory=vicell_dir)
+    D_flx = flex_import_cached(cache_dir, workers, directory=flex_dir)
+
+    print("#### Watch Update Report ####")
+    print("\n")
+    L_changed = list(D_vcl) + list(D_flx) if changed is None else changed
+    for key, value in file_reactors({**D_vcl, **D_flx}, L_changed).items():
+        print(key + ": " + str(value))
+
+    df_vcl, df_flx, merged, affected = merge_incremental(D_vcl, D_flx, os.path.join(state_dir, "merged"),
+                                                         dict_change, return_affected=True)
+
+    processed = pd.read_pickle(processed_path) if os.path.exists(processed_path) else None
+    if merged is None or (affected is not None and not affected and processed is not None):
+        print("No reactor changed")
+        return processed, affected, {}
+
+    # runtime and kinetics are per reactor: recomputed on the affected reactors only. After a merge from scratch
+    # (e.g. an export removed) everything is recomputed, reactors of removed files must not stay in processed
+    if affected is None:
+        processed = None
+    if processed is None:
+        affected = set(merged["Sample ID"].dropna())
+    sub = calc_qp(calc_runtime(merged[merged["Sample ID"].isin(affected)].copy()))
+    if processed is None:
+        processed = sub
+    else:
+        processed = _insert_sorted(processed[~processed["Sample ID"].isin(affected)], sub, "datetime")
+
+    processed.to_pickle(processed_path)
+    processed.to_csv(os.path.join(out_dir, "merged.csv"), index=False)
+
+    # figures that include an affected reactor
+    if jobs is None:
+        L_jobs = reactor_jobs(sorted(affected), os.path.join(out_dir, "figures"), **kwargs)
+    else:
+        L_jobs = [i for i in jobs if affected.intersection(i[0])]
+    print("Reactors updated: " + str(sorted(affected)))
+    print("Figures to re-render: " + str(len(L_jobs)))
+    D_results = render_batch(L_jobs, processed, workers) if L_jobs else {}
+
+    return processed, affected, D_results
+
+def watch(vicell_dir, flex_dir, out_dir, interval=30, max_updates=None, **kwargs):
+    """
+    Polls the export directories every interval seconds and runs update when files are added or modified. A file
+    is only picked up once its size and modification time are the same on two polls in a row, so exports still being
+    written are not parsed half way.
+
+    Input: vicell_dir, flex_dir, out_dir, interval (seconds), max_updates (int, stop after this many updates.
+           Default runs until interrupted), **kwargs - see update
+    """
+    directories = [(vicell_dir, "xlsx"), (flex_dir, "csv")]
+    seen = {}  # files as of the last update
+    previous = None
+    updates = 0
+
+    print("Watching " + str(vicell_dir) + " and " + str(flex_dir) + " every " + str(interval) + "s")
+    try:
+        while max_updates is None or updates < max_updates:
+            current = snapshot(directories)
+            changed = [i for i, sig in current.items() if seen.get(i) != sig]
+
+            if changed and current == previous:  # nothing written to since the last poll
+                start = time.perf_counter()
+                update(vicell_dir, flex_dir, out_dir, changed, **kwargs)
+                print("Update done in %.1fs" % (time.perf_counter() - start))
+                print("\n")
+                reset_records()  # stage records are per update, not kept for the life of the watch
+                seen = current
+                updates += 1
+                continue
+
+            previous = current
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vicell", required=True, help="directory of the ViCell .xlsx exports")
+    parser.add_argument("--flex", required=True, help="directory of the FLEX .csv exports")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--interval", type=float, default=30, help="seconds between polls")
+    parser.add_argument("--workers", type=int, default=None, help="processes for file parsing and rendering")
+    parser.add_argument("--rename", default=None, help="JSON file of FLEX sample IDs to rename: "
+                                                       '{"R0012": ["R00120", "R012"]}')
+    parser.add_argument("--xmax", type=float, default=None, help="x axis maximum of the figures (days)")
+    args = parser.parse_args(argv)
+
+    dict_change = None
+    if args.rename is not None:
+        with open(args.rename) as f:
+            dict_change = json.load(f)
+
+    kwargs = {} if args.xmax is None else {"xmax": args.xmax}
+    watch(args.vicell, args.flex, args.out, args.interval, workers=args.workers, dict_change=dict_change, **kwargs)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
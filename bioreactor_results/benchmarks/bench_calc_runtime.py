@@ -0,0 +1,92 @@
+"""
+Benchmark: calc_runtime scaling with number of reactors and rows.
+
+Compares the grouped, vectorized calc_runtime against the previous implementation (loop over Sample ID groups with
+a .loc write per group) and checks that both give the same Runtime values. The legacy loop accumulates rounding
+error in its running sum, so values are compared to 1e-9 days (well under a millisecond).
+
+usage (from bioreactor_results):
+    python benchmarks/bench_calc_runtime.py
+    python benchmarks/bench_calc_runtime.py --skip-legacy    # legacy loop takes minutes at 1M rows
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from BSRmerge import calc_runtime, flex_columns
+
+
+def legacy_runtime(df):
+    """
+    Runtime column as computed by calc_runtime before vectorization (loop over groups, .loc write per group)
+    """
+    df.sort_values(by="datetime", inplace=True)
+    df["Runtime"] = 0
+    for key, grp in df.groupby("Sample ID"):
+        time_delta = grp["datetime"].diff()
+        time_delta = time_delta.dt.total_seconds() / (24 * 60 * 60)
+        added_time = time_delta.cumsum()
+        added_time.iloc[0] = 0
+        df.loc[added_time.index, "Runtime"] = added_time
+    return df["Runtime"]
+
+
+def make_merged(n_reactors, n_rows, seed=0):
+    """
+    Synthetic merge_vcl_flx output: n_rows samples spread over n_reactors, random (unique) times over a 20 day run
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.array(["R%04d" % i for i in range(n_reactors)], dtype=object)
+    start = pd.Timestamp("2020-01-01")
+
+    df = pd.DataFrame({
+        "Sample ID": ids[rng.integers(0, n_reactors, n_rows)],
+        # unique timestamps, rows tied on datetime may come out of the two sorts in a different order
+        "datetime": start + pd.to_timedelta(rng.permutation(n_rows) * (20 / n_rows), unit="D"),
+        "Vicell Sample ID": None, "Flex Sample ID": None,
+        "Vicell date/time": pd.NaT, "Flex date/time": pd.NaT,
+        "Viable cells/ml (x10^6)": rng.random(n_rows) * 20, "Viability(%)": rng.random(n_rows) * 100,
+    })
+    for i in flex_columns[2:]:
+        df[i] = rng.random(n_rows)
+    return df
+
+
+def timed(func, df):
+    t = time.perf_counter()
+    result = func(df)
+    return result, time.perf_counter() - t
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--skip-legacy", action="store_true", help="only time the vectorized implementation")
+    args = parser.parse_args()
+
+    scales = [(10, 10000), (100, 100000), (1000, 100000), (1000, 1000000)]
+
+    print("%10s %10s %12s %12s %8s" % ("reactors", "rows", "vectorized", "legacy", "speedup"))
+    for n_reactors, n_rows in scales:
+        df = make_merged(n_reactors, n_rows)
+
+        result, t_new = timed(calc_runtime, df.copy())
+
+        if args.skip_legacy:
+            print("%10d %10d %11.3fs %12s %8s" % (n_reactors, n_rows, t_new, "-", "-"))
+            continue
+
+        legacy = df.copy()
+        runtime, t_old = timed(legacy_runtime, legacy)
+
+        # calc_runtime returns a reset index in the same sorted order as the legacy frame
+        np.testing.assert_allclose(result["Runtime"].to_numpy(), runtime.to_numpy(), rtol=0, atol=1e-9)
+        print("%10d %10d %11.3fs %11.3fs %7.1fx" % (n_reactors, n_rows, t_new, t_old, t_old / t_new))
+
+
+if __name__ == "__main__":
+    main()
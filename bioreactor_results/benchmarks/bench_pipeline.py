@@ -0,0 +1,188 @@
+"""
+Benchmark: ingest -> merge -> kinetics -> plot pipeline on synthetic exports (see synthetic.py).
+
+Every stage is timed, then run again under tracemalloc for its peak memory (tracemalloc slows python code down, so the
+two are measured in separate passes). Results can be saved as a baseline JSON, and later runs are compared against it:
+a stage slower (or larger) than the baseline by more than --tolerance is reported as a regression.
+benchmarks/baseline_pipeline.json is the reference run on the default synthetic dataset; timings are machine dependent,
+re-save it on the machine the comparisons run on.
+
+usage (from bioreactor_results):
+    python benchmarks/bench_pipeline.py --reactors 20 --days 14 --per-day 2 --files 4
+    python benchmarks/bench_pipeline.py --save-baseline     # writes benchmarks/baseline_pipeline.json
+    python benchmarks/bench_pipeline.py --workers 4         # parallel file parsing and rendering
+"""
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+
+import matplotlib
+matplotlib.use("Agg")
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+sys.path.insert(0, here)
+
+import pandas as pd
+
+from BSRmerge import (vicell_convert_xlsx, vicell_clean, vicell_convert_clean, vicell_merge_convert, flex_convert_csv,
+                      flex_check_format, flex_merge, merge_vcl_flx, calc_runtime)
+from BSRkinetics import calc_kinetics
+from BSRplots import render_batch, report_jobs
+from synthetic import generate
+
+default_baseline = os.path.join(here, "baseline_pipeline.json")
+
+
+def stages(workers, plot_reactors):
+    """
+    Pipeline stages in order: (name, function of the previous results). Functions take and return a dict of results
+    """
+    return [
+        ("vicell_convert_xlsx", lambda r: {"vicell": vicell_convert_xlsx(workers)}),
+        ("vicell_clean", lambda r: {"vicell": vicell_clean(r["vicell"])}),
+        ("vicell_convert_clean", lambda r: {"vicell_stream": vicell_convert_clean(workers)}),  # streaming reader
+        ("vicell_merge_convert", lambda r: {"df_vcl": vicell_merge_convert(r["vicell"])}),
+        ("flex_convert_csv", lambda r: {"flex": flex_convert_csv(workers)}),
+        ("flex_check_format", lambda r: {"flex": flex_check_format(r["flex"])}),
+        ("flex_merge", lambda r: {"df_flx": flex_merge(r["flex"])}),
+        ("merge_vcl_flx", lambda r: {"merged": merge_vcl_flx(r["df_vcl"], r["df_flx"])}),
+        ("calc_runtime", lambda r: {"merged": calc_runtime(r["merged"])}),
+        ("calc_kinetics", lambda r: {"merged": calc_kinetics(r["merged"])}),
+        ("render_batch", lambda r: {"figures": render_batch(
+            report_jobs(sorted(r["merged"]["Sample ID"].dropna().unique())[:plot_reactors]), r["merged"], workers)}),
+    ]
+
+def rows_of(value):
+    """
+    Number of rows in a stage result (dataframe, or dictionary of dataframes)
+    """
+    if isinstance(value, pd.DataFrame):
+        return value.shape[0]
+    if isinstance(value, dict):
+        frames = [i for i in value.values() if isinstance(i, pd.DataFrame)]
+        return sum(i.shape[0] for i in frames) if frames else len(value)  # figures rendered
+    return None
+
+def run_pipeline(data_dir, workers=None, plot_reactors=4, memory=False):
+    """
+    Runs every stage on the exports in data_dir. Figures are written to a scratch directory that is removed after.
+
+    Return: dictionary, key = stage name, value = {"seconds", "rows"} and "peak_mb" when memory is True
+    """
+    results = {}
+    measured = {}
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix="bench_pipeline_")
+
+    try:
+        for name, func in stages(workers, plot_reactors):
+            # the import stages list the working directory, the render stage saves figures to it
+            os.chdir(scratch if name == "render_batch" else data_dir)
+
+            if memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):  # pipeline reports are not part of the measurement
+                out = func(results)
+            seconds = time.perf_counter() - start
+            if memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            results.update(out)
+            measured[name] = {"seconds": seconds, "rows": rows_of(list(out.values())[0])}
+            if memory:
+                measured[name]["peak_mb"] = peak / 1024 ** 2
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return measured
+
+def compare(current, baseline, tolerance):
+    """
+    Stages where the current run is slower, or uses more memory, than the baseline by more than tolerance (fraction)
+
+    Return: list of str, one per regression
+    """
+    regressions = []
+    for name, stage in current.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ("seconds", "peak_mb"):
+            if metric in stage and metric in base and base[metric] > 0 and \
+                    stage[metric] > base[metric] * (1 + tolerance):
+                regressions.append("%s %s: %.3f -> %.3f (%+.0f%%)" % (name, metric, base[metric], stage[metric],
+                                                                    100 * (stage[metric] / base[metric] - 1)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reactors", type=int, default=20)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--per-day", type=int, default=2, help="samples per reactor per day")
+    parser.add_argument("--files", type=int, default=4, help="files per instrument")
+    parser.add_argument("--workers", type=int, default=None, help="processes for file parsing and rendering")
+    parser.add_argument("--plot-reactors", type=int, default=4, help="reactors in the rendered report figures")
+    parser.add_argument("--data-dir", default=None, help="reuse (or keep) generated exports in this directory")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="regression threshold, fraction of baseline")
+    args = parser.parse_args()
+
+    config = {"reactors": args.reactors, "days": args.days, "per_day": args.per_day, "files": args.files,
+              "workers": args.workers, "plot_reactors": args.plot_reactors}
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bench_data_")
+    try:
+        if not any(i.endswith((".xlsx", ".csv")) for i in os.listdir(data_dir)):
+            start = time.perf_counter()
+            generate(data_dir, args.reactors, args.days, args.per_day, args.files)
+            print("generated exports in %.1fs: %s" % (time.perf_counter() - start, data_dir))
+
+        measured = run_pipeline(data_dir, args.workers, args.plot_reactors)
+        if not args.no_memory:
+            for name, stage in run_pipeline(data_dir, args.workers, args.plot_reactors, memory=True).items():
+                measured[name]["peak_mb"] = stage["peak_mb"]
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    print("%-22s %10s %10s %12s" % ("stage", "seconds", "rows", "peak MB"))
+    for name, stage in measured.items():
+        print("%-22s %10.3f %10s %12s" % (name, stage["seconds"], stage["rows"],
+                                          "%.1f" % stage["peak_mb"] if "peak_mb" in stage else "-"))
+    print("%-22s %10.3f" % ("total", sum(i["seconds"] for i in measured.values())))
+
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("\nbaseline was recorded with a different configuration: " + str(baseline.get("config")))
+        else:
+            regressions = compare(measured, baseline["stages"], args.tolerance)
+            print("\nregressions against baseline: " + (str(len(regressions)) if regressions else "none"))
+            for i in regressions:
+                print("  " + i)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"config": config, "python": platform.python_version(), "pandas": pd.__version__,
+                       "machine": platform.machine(), "stages": measured}, f, indent=2)
+        print("\nbaseline saved: " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Synthetic bioreactor exports for benchmarks: ViCell xlsx files and Nova FLEX csv files in the layouts
+vicell_check_format / vicell_clean and flex_read_csv / flex_check_format expect.
+
+Every reactor is sampled samples_per_day times a day for days days. Each ViCell sample has a FLEX sample of the same
+reactor a few minutes later (inside the merge_vcl_flx tolerance), and QC samples are mixed into the FLEX exports so
+the Sample ID check has something to reject. Reactors are spread over n_files files per instrument.
+
+usage (from bioreactor_results):
+    python benchmarks/synthetic.py OUT_DIR --reactors 20 --days 14 --per-day 2 --files 4
+"""
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# FLEX export columns, an instrument column the pipeline drops is kept in to be realistic
+flex_export_columns = ['Sample ID', 'Date & Time', 'Gln', 'Glu', 'Gluc', 'Lac', 'NH4+', 'Na+', 'K+', 'Ca++', 'pH',
+                       'PO2', 'PCO2', 'O2 Saturation', 'Osm', 'Vessel Temperature (°C)', 'Chemistry Dilution Ratio',
+                       'HCO3', 'Operator']
+
+# ViCell header block: title, bioprocess line, column names split over 2 rows, column numbers
+vicell_header = [["Vi-CELL BLU"] + [None] * 9,
+                 [None] * 10,
+                 [None] * 10,
+                 ["Bioprocess:"] + [None] * 9,
+                 ["Sample ID", "File name", "Cell type", "Dilution", "Sample date/time", "Status", "Total", "Viability",
+                  "Viable", "Viable cells"],
+                 [None] * 7 + ["(%)", None, "/ml (x10^6)"],
+                 [0, 1, 2, 10, 11, 12, 13, 14, 15, 16]]
+
+
+def reactor_ids(n_reactors):
+    return ["R%04d" % i for i in range(1, n_reactors + 1)]
+
+def sample_times(n_reactors, days, samples_per_day, rng, start="2020-01-06 09:00"):
+    """
+    Sampling times of every reactor: evenly spaced through the day, a few minutes of jitter, reactors started on a
+    staggered schedule (one new reactor every 3 hours)
+
+    Return: tuple (reactor position, elapsed days, timestamps), one entry per sample
+    """
+    n_samples = days * samples_per_day
+    reactor = np.repeat(np.arange(n_reactors), n_samples)
+    elapsed = np.tile(np.arange(n_samples) / samples_per_day, n_reactors)
+    seconds = np.round(elapsed * 86400) + reactor * 3 * 3600 + rng.integers(0, 20 * 60, len(elapsed))  # jitter
+    return reactor, elapsed, pd.Timestamp(start) + pd.to_timedelta(unique_seconds(seconds), unit="s")
+
+def unique_seconds(seconds):
+    """
+    Moves samples that landed on the same second apart: the merge stages drop rows with duplicate timestamps
+    """
+    seconds = np.asarray(seconds, dtype=np.int64).copy()
+    while True:
+        order = np.argsort(seconds, kind="stable")
+        dup = np.flatnonzero(seconds[order][1:] == seconds[order][:-1]) + 1
+        if len(dup) == 0:
+            return seconds
+        seconds[order[dup]] += 1
+
+def growth_curves(elapsed, rng):
+    """
+    Fed-batch like VCD (logistic growth, 10E6 cells/mL) and viability (%) over elapsed days
+    """
+    peak = rng.uniform(15, 30, len(elapsed))
+    vcd = peak / (1 + (peak / 0.5 - 1) * np.exp(-0.7 * elapsed))
+    vcd *= 1 - np.clip(elapsed - 10, 0, None) * 0.06  # decline phase
+    viability = 98 - np.clip(elapsed - 8, 0, None) ** 1.5 * 0.8
+    return (np.round(np.clip(vcd, 0.05, None) * rng.normal(1, 0.03, len(elapsed)), 2),
+            np.round(np.clip(viability + rng.normal(0, 0.5, len(elapsed)), 40, 100), 1))
+
+def flex_values(elapsed, rng):
+    """
+    FLEX analytes over elapsed days, in the ranges a CHO fed-batch shows. Rounded to the instrument precision
+    """
+    n = len(elapsed)
+    noise = lambda scale: rng.normal(0, scale, n)
+    values = {
+        'Gln': np.clip(6 - 0.6 * elapsed, 0, None) + noise(0.1),
+        'Glu': 1 + 0.2 * elapsed + noise(0.1),
+        'Gluc': 6 - 0.25 * (elapsed % 3) * 2 + noise(0.2),
+        'Lac': 2.5 * np.sin(np.clip(elapsed, 0, 14) / 14 * np.pi) + noise(0.1),
+        'NH4+': 1 + 0.5 * elapsed + noise(0.2),
+        'Na+': 135 + elapsed + noise(1),
+        'K+': 6 + noise(0.2),
+        'Ca++': 1 + noise(0.05),
+        'pH': 7.1 - 0.01 * elapsed + noise(0.02),
+        'PO2': 80 + noise(10),
+        'PCO2': 40 + 2 * elapsed + noise(3),
+        'O2 Saturation': 50 + noise(5),
+        'Osm': 300 + 8 * elapsed + noise(5),
+        'Vessel Temperature (°C)': 36.5 + noise(0.1),
+        'Chemistry Dilution Ratio': np.ones(n),
+        'HCO3': 30 + noise(2),
+    }
+    precision = {'pH': 2, 'Osm': 0, 'PO2': 0, 'PCO2': 0, 'O2 Saturation': 0, 'Na+': 0, 'Vessel Temperature (°C)': 1}
+    return {k: np.round(np.clip(v, 0, None), precision.get(k, 2)) for k, v in values.items()}
+
+def write_vicell_xlsx(path, ids, times, vcd, viability):
+    """
+    One ViCell export: header block followed by one row per sample
+    """
+    body = pd.DataFrame({
+        0: [i + "_" + str(n) for n, i in enumerate(ids)],  # ViCell sample names carry a suffix, cleaned to 5 chars
+        1: [i + "x" for i in ids],
+        2: "CHO",
+        3: 1,
+        4: pd.Series(times).dt.strftime("%Y-%m-%d %H:%M:%S").to_numpy(),
+        5: 0,
+        6: np.round(vcd / (viability / 100), 2),
+        7: viability,
+        8: 0,
+        9: vcd,
+    })
+    sheet = pd.concat([pd.DataFrame(vicell_header), body], ignore_index=True)
+    sheet.to_excel(path, index=False, header=False)
+
+def write_flex_csv(path, ids, times, values):
+    """
+    One FLEX export
+    """
+    df = pd.DataFrame({"Sample ID": ids, "Date & Time": pd.Series(times).dt.strftime("%m/%d/%Y %H:%M:%S").to_numpy()})
+    for i in flex_export_columns[2:-1]:
+        df[i] = values[i]
+    df["Operator"] = "bench"
+    df.to_csv(path, index=False)
+
+def generate(out_dir, n_reactors=20, days=14, samples_per_day=2, n_files=4, qc_fraction=0.05, seed=0):
+    """
+    Writes n_files ViCell xlsx files and n_files FLEX csv files to out_dir.
+
+    Return: dictionary, "vicell_files", "flex_files" (lists of paths), "vicell_rows", "flex_rows", "reactors"
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    ids = np.array(reactor_ids(n_reactors), dtype=object)
+
+    reactor, elapsed, times = sample_times(n_reactors, days, samples_per_day, rng)
+    vcd, viability = growth_curves(elapsed, rng)
+
+    # FLEX samples a few minutes after the ViCell sample, plus QC runs the format check rejects
+    start = times.min()
+    flex_seconds = (times - start).total_seconds().to_numpy() + rng.integers(2 * 60, 15 * 60, len(times))
+    flex_times = start + pd.to_timedelta(unique_seconds(flex_seconds), unit="s")
+    values = flex_values(elapsed, rng)
+    flex_ids = ids[reactor]
+    n_qc = int(len(times) * qc_fraction)
+    qc_rows = rng.choice(len(times), n_qc, replace=False)
+    flex_ids = flex_ids.copy()
+    flex_ids[qc_rows] = "QC" + pd.Series(rng.integers(1, 4, n_qc)).astype(str).to_numpy()
+
+    # reactors spread over the files
+    file_of = reactor % n_files
+    vicell_files, flex_files = [], []
+    for f in range(n_files):
+        rows = np.flatnonzero(file_of == f)
+        if len(rows) == 0:
+            continue
+        vicell_path = os.path.join(out_dir, "vicell_%03d.xlsx" % f)
+        flex_path = os.path.join(out_dir, "flex_%03d.csv" % f)
+        write_vicell_xlsx(vicell_path, ids[reactor[rows]], times[rows], vcd[rows], viability[rows])
+        write_flex_csv(flex_path, flex_ids[rows], flex_times[rows], {k: v[rows] for k, v in values.items()})
+        vicell_files.append(vicell_path)
+        flex_files.append(flex_path)
+
+    return {"vicell_files": vicell_files, "flex_files": flex_files, "vicell_rows": len(times),
+            "flex_rows": len(times), "reactors": list(ids)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_dir")
+    parser.add_argument("--reactors", type=int, default=20)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--per-day", type=int, default=2, help="samples per reactor per day")
+    parser.add_argument("--files", type=int, default=4, help="files per instrument")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    result = generate(args.out_dir, args.reactors, args.days, args.per_day, args.files, seed=args.seed)
+    print("ViCell files: %d (%d rows)" % (len(result["vicell_files"]), result["vicell_rows"]))
+    print("FLEX files: %d (%d rows)" % (len(result["flex_files"]), result["flex_rows"]))
+
+
+if __name__ == "__main__":
+    main()
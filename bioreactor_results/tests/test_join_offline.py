@@ -0,0 +1,54 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from BSRmerge import join_offline
+
+
+def timeline():
+    """
+    calc_runtime style timeline of 2 reactors, 3 days each, with FLEX Gln and an empty Titer column
+    """
+    return pd.DataFrame({
+        "Sample ID": ["R0001", "R0001", "R0001", "R0002", "R0002", "R0002"],
+        "datetime": pd.to_datetime(["2024-01-01", "2024-01-02", "2024-01-03"] * 2),
+        "Runtime": [0.0, 1.0, 2.0] * 2,
+        "Gln": [4.0, 3.5, 3.0, 4.1, 3.6, 3.1],
+        "Titer": np.nan,
+    })
+
+def test_existing_column_is_not_overwritten():
+    df = timeline()
+    aa = pd.DataFrame({"Sample": ["R0001", "R0002"], "Reactor Day": [1.1, 2.0], "Gln": [2.2, 1.9]})
+
+    out = join_offline(df, {"aa": {"df": aa, "columns": ["Gln"]}})
+
+    pd.testing.assert_series_equal(out["Gln"], df["Gln"])
+    assert out["aa Gln"].tolist()[1] == 2.2
+    assert out["aa Gln"].tolist()[5] == 1.9
+    assert out["aa Gln"].isna().sum() == 4
+
+def test_empty_column_is_filled_and_missing_values_skipped():
+    df = timeline()
+    titer = pd.DataFrame({"Sample": ["R0001", "R0001", "R0002"], "Reactor Day": [1.0, 2.0, 2.0],
+                          "mg/L": [150.0, np.nan, 210.0]})
+
+    out = join_offline(df, {"titer": {"df": titer, "columns": {"mg/L": "Titer"}}})
+
+    assert "titer Titer" not in out.columns
+    assert out["Titer"].tolist()[1] == 150.0
+    assert out["Titer"].tolist()[5] == 210.0
+    assert out["Titer"].isna().sum() == 4  # the missing day 2 value of R0001 is not written
+
+def test_collision_with_prefixed_column_raises():
+    df = timeline()
+    df["aa Gln"] = 1.0
+    aa = pd.DataFrame({"Sample": ["R0001"], "Reactor Day": [1.0], "Gln": [2.2]})
+
+    with pytest.raises(ValueError):
+        join_offline(df, {"aa": {"df": aa, "columns": ["Gln"]}})
@@ -0,0 +1,117 @@
+import pandas as pd
+import numpy as np
+import os
+
+# logbook columns, same entries as the notebook data_dictionary
+logbook_columns = ["datetime", "passage/flask#", "culture_day", "VCD", "viability"]
+
+# "passage/flask#" entries: p4d = passage 4, flask d
+flask_pattern = r"^\s*[pP](?P<passage>\d+)\s*(?P<flask_id>[A-Za-z0-9]+)\s*$"
+
+
+def _parse_datetime(values):
+    """
+    Logbook datetime: year-month-day-hour-minute numbers (201802051155) as typed in the notebook, or datetimes
+    already parsed by excel
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+
+    text = values.astype(str).str.replace(r"\.0$", "", regex=True)
+    if text.str.fullmatch(r"\d{12}").all():
+        return pd.to_datetime(text, format="%Y%m%d%H%M")
+    return pd.to_datetime(text)
+
+def _parse_chunk(df, source):
+    """
+    Checks and types one block of logbook rows. Passage and flask are parsed from "passage/flask#" once per unique
+    entry.
+
+    Return: tuple (typed dataframe, dataframe of rejected rows)
+    """
+    missing = [i for i in logbook_columns if i not in df.columns]
+    if missing:
+        raise KeyError(str(source) + " is missing logbook columns: " + str(missing))
+
+    df = df[logbook_columns].dropna(how="all").copy()
+    df["source"] = os.path.basename(str(source))
+
+    codes, uniques = pd.factorize(df["passage/flask#"].astype(str))
+    parts = pd.Series(uniques, dtype=object).str.extract(flask_pattern)
+    df["passage"] = parts["passage"].astype(float).to_numpy()[codes]
+    df["flask_id"] = parts["flask_id"].to_numpy(dtype=object)[codes]
+
+    rejected = df["flask_id"].isna() | df["datetime"].isna()
+    df_rejected = df[rejected]
+    df = df[~rejected].copy()
+
+    df["datetime"] = _parse_datetime(df["datetime"])
+    df["passage"] = df["passage"].astype(int)
+    for i in ["culture_day", "VCD", "viability"]:
+        df[i] = pd.to_numeric(df[i], errors="coerce")
+
+    return df, df_rejected
+
+def read_logbook(path, chunksize=100000):
+    """
+    Reads an expansion logbook (csv, xlsx or xls) with columns: "datetime", "passage/flask#", "culture_day", "VCD",
+    "viability". csv logbooks are read in blocks of chunksize rows, so large logbooks are never parsed in one piece.
+
+    Return: tuple (dataframe of records, dataframe of rejected rows)
+    """
+    if str(path).lower().endswith((".xlsx", ".xls")):
+        blocks = [pd.read_excel(path)]
+    else:
+        blocks = pd.read_csv(path, chunksize=chunksize)
+
+    L_df, L_rejected = [], []
+    for block in blocks:
+        df, df_rejected = _parse_chunk(block, path)
+        L_df.append(df)
+        L_rejected.append(df_rejected)
+
+    return pd.concat(L_df, ignore_index=True), pd.concat(L_rejected, ignore_index=True)
+
+def load_logbooks(paths, chunksize=100000):
+    """
+    Loads expansion records from one or more logbooks, in place of data_dictionary / fn0_raw_to_dataframe.
+
+    Input: paths - path or list of paths (csv, xlsx or xls), chunksize - csv rows parsed at a time
+    Return: pandas dataframe with datetime index, sorted chronologically (entry order kept within a timestamp), and
+            new columns: "passage" - int, "flask_id" - flask letter(s) from "passage/flask#", "source" - logbook file.
+            Ready for expansion_kinetics.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    L_df, L_rejected = [], []
+    for i in paths:
+        df, df_rejected = read_logbook(i, chunksize)
+        L_df.append(df)
+        L_rejected.append(df_rejected)
+
+    df = pd.concat(L_df, ignore_index=True)
+    df_rejected = pd.concat(L_rejected, ignore_index=True)
+
+    df.sort_values(by="datetime", kind="mergesort", inplace=True)
+    df.set_index(pd.DatetimeIndex(df["datetime"]), inplace=True)
+
+    print("#### Logbook Report ####")
+    print("\n")
+    print("Logbooks read: " + str(len(paths)))
+    print("Records: " + str(df.shape[0]))
+    print("Flasks: " + str(df["flask_id"].nunique()))
+    if df_rejected.shape[0] > 0:
+        print("Rejected rows (passage/flask# not p<passage><flask> or no datetime): " + str(df_rejected.shape[0]))
+        print(df_rejected[["source", "datetime", "passage/flask#"]].to_string())
+
+    return df
+
+def split_flasks(df, flask="flask_id"):
+    """
+    Splits records into one dataframe per flask in a single grouped pass.
+
+    Return: dictionary, key = "df_flask_#" where # is flask id (same keys as extract_unique_flasks),
+            value = dataframe of that flask, in first appearance order
+    """
+    return {"df_flask_" + str(key): grp for key, grp in df.groupby(flask, sort=False)}
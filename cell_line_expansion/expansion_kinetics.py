@@ -0,0 +1,89 @@
+import pandas as pd
+import numpy as np
+
+
+def _flask_layout(df, flask):
+    """
+    Row order that groups the rows of every flask together, keeping the row order within a flask.
+
+    Return: tuple (order, first). order = positions into df, first = bool array (in that order), True on the first
+            row of every flask
+    """
+    codes = pd.factorize(df[flask])[0]
+    order = np.argsort(codes, kind="mergesort")
+    codes = codes[order]
+
+    first = np.ones(len(codes), dtype=bool)
+    first[1:] = codes[1:] != codes[:-1]
+    return order, first
+
+def _step(values, first):
+    """
+    Difference to the previous row of the same flask, NaN on the first row of every flask
+    """
+    result = np.full(len(values), np.nan)
+    result[1:] = values[1:] - values[:-1]
+    result[first] = np.nan
+    return result
+
+def expansion_kinetics(df, flask="flask_id", time=None):
+    """
+    Computes the expansion kinetics of every flask at once. Rows are grouped by flask, and keep their order within a
+    flask (chronological, as entered).
+
+    dependancy - dataframe with a datetime index (fn0_raw_to_dataframe) and columns: "VCD", flask
+
+    New columns:
+    Time_diff - elapsed time (days) from the first row of the flask
+    mu - specific growth rate (1/day), ln(VCD) difference to the previous row of the flask / time difference
+    Doubling_time - hours, ln(2) / mu * 24. Nan when there is no growth (VCD lower than the previous row)
+    Generations - running total of log2(VCD) differences over the rows with growth. Nan when there is no growth,
+                  the next growth row carries on from the previous total
+
+    The first row of every flask has Time_diff 0 and Nan for everything else.
+
+    PARAMETERS
+
+    df: dataframe input
+    flask: column identifying the flask (default "flask_id")
+    time: column with the sample datetime. Default uses the datetime index
+
+    RETURN
+
+    df: original dataframe is returned with the additional columns.
+    """
+
+    order, first = _flask_layout(df, flask)
+
+    if time is None:
+        timestamps = pd.Series(df.index, index=df.index)
+    else:
+        timestamps = df[time]
+    timestamps = pd.to_datetime(timestamps).to_numpy(dtype="datetime64[ns]")[order]
+
+    # elapsed days from the first row of the flask
+    start = np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))  # first row of the flask, every row
+    elapsed = (timestamps - timestamps[start]) / np.timedelta64(1, "D")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vcd = df["VCD"].to_numpy(dtype=float)[order]
+        ln_step = _step(np.log(vcd), first)
+        log2_step = _step(np.log2(vcd), first)
+
+        growth = ~(ln_step < 0)  # no growth: VCD lower than the previous row. Nan (first row) is left as it is
+
+        mu = ln_step / _step(elapsed, first)
+        doubling = np.where(growth, np.log(2) / mu * 24, np.nan)
+
+    # generations keep adding up over growth rows only
+    generation = np.where(growth & ~first, log2_step, 0)
+    total = pd.Series(generation).groupby(np.cumsum(first)).cumsum().to_numpy()
+    generations = np.where(growth & ~first, total, np.nan)
+
+    # back to the original row order
+    for clm, values in [("Time_diff", elapsed), ("mu", mu), ("Doubling_time", doubling), ("Generations", generations)]:
+        result = np.empty(len(order))
+        result[order] = values
+        df[clm] = result
+
+    return df